@@ -0,0 +1,189 @@
+"""Benchmarks of the build/measure hot paths.
+
+Run from the repository root:
+    python Benchmarks/benchmarks.py                           # Run and print
+    python Benchmarks/benchmarks.py --save baseline.json      # Store a baseline
+    python Benchmarks/benchmarks.py --compare baseline.json   # Flag regressions against a baseline (same machine)
+Every run also checks that `import pywarraychannels.channels` (what workers import) stays within --import-budget.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+import pywarraychannels
+
+### Workloads
+def test_rays():
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Demos", "TestRays.txt")) as f:
+        return pywarraychannels.em.Geometric([[float(p) for p in ray.split()] for ray in f.read().split("\n")[:-1]])
+
+def synthetic_rays(n, seed=0):
+    """n random rays with delays spread over 100 ns"""
+    rng = np.random.default_rng(seed)
+    return pywarraychannels.em.Geometric(np.stack([
+        rng.uniform(-180, 180, n),          # Phase
+        rng.uniform(1e-7, 2e-7, n),         # Time of arrival
+        rng.uniform(-120, -60, n),          # Power
+        rng.uniform(-180, 180, n),          # DoA azimuth
+        rng.uniform(-80, 80, n),            # DoA elevation
+        rng.uniform(-180, 180, n),          # DoD azimuth
+        rng.uniform(-80, 80, n)], axis=1))  # DoD elevation
+
+def geometric(N_RX=16, N_TX=16, K=128, tolerance=None, dtype="complex"):
+    antenna_RX = pywarraychannels.antennas.LinearAntenna(N_RX, dtype=dtype)
+    antenna_TX = pywarraychannels.antennas.LinearAntenna(N_TX, dtype=dtype)
+    return pywarraychannels.channels.Geometric(
+        antenna_RX, antenna_TX, K=K,
+        filter=pywarraychannels.filters.RCFilter(0.22, early_samples=16, late_samples=16, tolerance=tolerance),
+        dtype=dtype)
+
+### Benchmarks, each returns the function to time and the work it does (amount, unit)
+def bench_build(rays, **kwargs):
+    def setup():
+        channel = geometric(**kwargs)
+        T = len(channel.f_k_rel) + 32
+        return lambda: channel.build(rays), len(rays.ray_info)*len(channel.antenna_RX.antenna_elements)*len(channel.antenna_TX.antenna_elements)*T, "ray-taps"
+    return setup
+
+def bench_measure(mode, signal=None):
+    def setup():
+        channel = geometric()
+        channel.build(test_rays())
+        plan = channel.plan([1] if signal is None else signal, mode)
+        return lambda: plan.apply(channel.channel), channel.channel.size, "channel entries"
+    return setup
+
+def bench_mimo():
+    channel = pywarraychannels.channels.MIMO(geometric())
+    channel.build(test_rays())
+    return lambda: channel.measure(), channel.channel_dependency.channel.size, "channel entries"
+
+def bench_awgn_rician():
+    channel = pywarraychannels.channels.AWGN(pywarraychannels.channels.Rician(geometric()))
+    rays = test_rays()
+    def run():
+        channel.build(rays)
+        return channel.measure()
+    return run, len(rays.ray_info), "rays"
+
+def bench_filter_response(tolerance):
+    def setup():
+        filter = pywarraychannels.filters.RCFilter(0.22, early_samples=16, late_samples=16, tolerance=tolerance)
+        delay = np.random.default_rng(0).uniform(0, 100, (64, 16, 16))
+        return lambda: filter.response(128, delay), delay.size*(128+32), "samples"
+    return setup
+
+def bench_array_factor():
+    antenna = pywarraychannels.antennas.RectangularAntenna((8, 8))
+    dirs = pywarraychannels.em.polar2cartesian(*np.radians(np.meshgrid(np.arange(-180, 180, 2), np.arange(-90, 90, 2))))
+    dirs = np.reshape(dirs, (-1, 3))
+    return lambda: antenna.array_factor(dirs), len(dirs), "directions"
+
+def bench_import(module):
+    def setup():
+        command = [sys.executable, "-c", "import " + module]
+        env = dict(os.environ, PYTHONPATH=SRC)
+        return lambda: subprocess.run(command, check=True, env=env), 1, "imports"
+    return setup
+
+BENCHMARKS = {
+    "build_rays_testrays": bench_build(test_rays()),
+    "build_rays_100": bench_build(synthetic_rays(100)),
+    "build_rays_400": bench_build(synthetic_rays(400)),
+    "build_array_8x8": bench_build(test_rays(), N_RX=8, N_TX=8),
+    "build_array_64x64": bench_build(test_rays(), N_RX=64, N_TX=64),
+    "build_taps_512": bench_build(test_rays(), K=512),
+    "build_tolerance": bench_build(test_rays(), tolerance=1e-4),
+    "build_complex64": bench_build(test_rays(), dtype="complex64"),
+    "measure_pairs": bench_measure("Pairs"),
+    "measure_pairs_signal": bench_measure("Pairs", np.ones(128)),
+    "measure_sequential": bench_measure("Sequential"),
+    "mimo_measure": bench_mimo,
+    "awgn_rician_build_measure": bench_awgn_rician,
+    "filter_response": bench_filter_response(None),
+    "filter_response_tolerance": bench_filter_response(1e-4),
+    "array_factor": bench_array_factor,
+    "import_package": bench_import("pywarraychannels"),
+    "import_channels": bench_import("pywarraychannels.channels"),
+}
+
+### Runner
+def run(name, repeat=5):
+    function, amount, unit = BENCHMARKS[name]()
+    function()                                              # Warm-up (caches, lookup tables, plans)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    # Peak memory from a separate run, tracemalloc slows the allocations down
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    time_median = float(np.median(times))
+    return {"time": time_median, "time_min": float(np.min(times)), "throughput": amount/time_median, "unit": unit, "peak_bytes": peak}
+
+def import_time(module, repeat=5):
+    """Best cumulative import time [s] of module in a fresh interpreter, as reported by python -X importtime"""
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+            check=True, capture_output=True, text=True, env=dict(os.environ, PYTHONPATH=SRC)).stderr
+        times.append(max(int(line.split("|")[1])*1e-6 for line in output.splitlines() if line.split("|")[-1].strip() == module))
+    return min(times)
+
+def machine():
+    return {"platform": platform.platform(), "processor": platform.processor(), "python": platform.python_version(), "numpy": np.__version__}
+
+def compare(results, baseline, tolerance):
+    """Names of the benchmarks slower or more memory hungry than the baseline by more than tolerance (relative)"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            continue
+        reference = baseline["results"][name]
+        # Best-of-repeats times, the least sensitive to other load on the machine
+        time_ratio, memory_ratio = result["time_min"]/reference["time_min"], result["peak_bytes"]/max(reference["peak_bytes"], 1)
+        flag = time_ratio > 1 + tolerance or memory_ratio > 1 + tolerance
+        print("{:<28s} time x{:.2f}  memory x{:.2f}{}".format(name, time_ratio, memory_ratio, "  REGRESSION" if flag else ""))
+        if flag:
+            regressions.append(name)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="*", help="Benchmarks to run (all by default): " + ", ".join(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", help="Store the results as a JSON baseline")
+    parser.add_argument("--compare", help="JSON baseline to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative slowdown/memory growth considered a regression")
+    parser.add_argument("--import-budget", type=float, default=0.25, help="Time [s] allowed for import pywarraychannels.channels")
+    args = parser.parse_args()
+    results = {}
+    for name in args.names or BENCHMARKS:
+        results[name] = result = run(name, args.repeat)
+        print("{:<28s} {:9.2f} ms  {:10.3g} {}/s  peak {:8.1f} MiB".format(
+            name, 1e3*result["time"], result["throughput"], result["unit"], result["peak_bytes"]/2**20))
+    time_import = import_time("pywarraychannels.channels")
+    print("{:<28s} {:9.2f} ms  budget {:.2f} ms{}".format("import channels", 1e3*time_import, 1e3*args.import_budget, "  OVER BUDGET" if time_import > args.import_budget else ""))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"machine": machine(), "results": results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["machine"] != machine():
+            print("Warning: the baseline was recorded on a different machine")
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+    if time_import > args.import_budget:
+        sys.exit(1)
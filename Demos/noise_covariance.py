@@ -0,0 +1,28 @@
+import pywarraychannels
+import numpy as np
+
+# Define antennas, the reduced RX codebook has overlapping beams so its correlation isn't the identity
+antenna_RX = pywarraychannels.antennas.LinearAntenna(16)
+antenna_RX.set_reduced_codebook(8)
+antenna_TX = pywarraychannels.antennas.LinearAntenna(4)
+
+# Noise only channel (power=0), correlated along the RX codebook entries
+channel = pywarraychannels.channels.AWGN(
+    pywarraychannels.channels.MIMO(
+        pywarraychannels.channels.Geometric(antenna_RX, antenna_TX, K=16)),
+    power=0, noise=1, rng=0)
+channel.set_corr(antenna_RX.codebook_corr())
+
+# Read TestRays
+with open("Demos/TestRays.txt") as f:
+    rays = pywarraychannels.em.Geometric([[float(p) for p in ray.split()] for ray in f.read().split("\n")[:-1]])
+channel.build(rays)
+
+# Empirical covariance of the noise along the RX entries
+noise = channel.measure(n_realizations=4000)
+noise = np.reshape(np.moveaxis(noise, -2, 0), (noise.shape[-2], -1))
+covariance = np.dot(noise, np.conj(noise.T))/noise.shape[1]
+corr = antenna_RX.codebook_corr()
+error = np.linalg.norm(covariance-corr)/np.linalg.norm(corr)
+print("Noise covariance relative error: {:.4f} (imaginary part of the correlation {:.2f})".format(error, np.linalg.norm(corr.imag)/np.linalg.norm(corr)))
+assert error < 0.03
@@ -1,6 +1,12 @@
-from . import utils
-from . import em
-from . import uncertainties
-from . import antennas
-from . import filters
-from . import channels
\ No newline at end of file
+import importlib
+
+# Submodules are imported on first access (e.g. pywarraychannels.channels), so importing the package stays cheap
+__all__ = ["utils", "em", "uncertainties", "antennas", "filters", "profiling", "channels", "store", "datasets", "beamtraining", "backends"]
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,14 +1,112 @@
 import numpy as np
-import numexpr as ne
-import scipy.fft as sfft
+import pywarraychannels.backends
 import pywarraychannels.uncertainties
+import pywarraychannels.em
+
+sfft = pywarraychannels.backends.LazyModule("scipy.fft", pywarraychannels.backends.NumpyFFT)
+
+### Codebook operators
+class DenseCodebook():
+    def __init__(self, codebook):
+        """Arbitrary (N, M) codebook"""
+        self.codebook = codebook
+        self.shape = np.shape(codebook)
+    def apply(self, x, axis, bool_conj=False):
+        """Contract the antenna axis of x with the codebook (conjugated if bool_conj), the codebook entries take its place"""
+        codebook = np.conj(self.codebook) if bool_conj else self.codebook
+        return np.moveaxis(np.tensordot(x, codebook, axes = (axis, 0)), -1, axis)
+    def cost(self):
+        """Multiplications per antenna vector"""
+        return self.shape[0]*self.shape[1]
+    def dense(self):
+        return self.codebook
+
+class DFTCodebook():
+    def __init__(self, codebook, taper, sign):
+        """(N, M) codebook taper[n]*exp(sign*2j*pi*n*m/M), a (possibly oversampled or reduced) DFT applied with FFTs"""
+        self.codebook = codebook
+        self.shape = np.shape(codebook)
+        # A constant taper (plain DFT) is kept as a scalar
+        self.taper = taper[0] if np.all(taper == taper[0]) else taper
+        self.sign = sign
+    def apply(self, x, axis, bool_conj=False):
+        N, M = self.shape
+        axis = axis % np.ndim(x)
+        taper = np.conj(self.taper) if bool_conj else self.taper
+        if np.ndim(taper) == 0:
+            x = x*taper.item()
+        else:
+            x = x*np.reshape(taper.astype(np.result_type(x, np.complex64), copy=False), (N,) + (1,)*(np.ndim(x)-axis-1))
+        if N > M:
+            # Entries repeat every M antennas, fold them before a length M transform
+            x = np.pad(x, [(0, 0)]*axis + [(0, -N % M)] + [(0, 0)]*(np.ndim(x)-axis-1))
+            x = np.sum(np.reshape(x, x.shape[:axis] + (-1, M) + x.shape[axis+1:]), axis=axis)
+        if (self.sign < 0) != bool_conj:
+            return sfft.fft(x, M, axis=axis)
+        return sfft.ifft(x, M, axis=axis, norm="forward")
+    def cost(self):
+        """Multiplications per antenna vector (FFT estimate)"""
+        N, M = self.shape
+        return N + 2*M*max(np.log2(M), 1)
+    def dense(self):
+        return self.codebook
+
+def codebook_operator(codebook):
+    """DFTCodebook if codebook is a (tapered) DFT, DenseCodebook otherwise"""
+    if np.ndim(codebook) == 2 and np.iscomplexobj(codebook):
+        N, M = np.shape(codebook)
+        taper = codebook[:, 0]
+        phase = 2j*np.pi*np.outer(np.arange(N), np.arange(M))/M
+        tolerance = 100*np.finfo(codebook.dtype).eps*np.max(np.abs(taper), initial=0)
+        for sign in [-1, 1]:
+            if np.max(np.abs(codebook - taper[:, np.newaxis]*np.exp(sign*phase)), initial=0) <= tolerance:
+                return DFTCodebook(codebook, taper, sign)
+    return DenseCodebook(codebook)
+
+class KroneckerCodebook():
+    def __init__(self, codebook1, codebook2):
+        """Codebook np.kron(codebook1, codebook2) applied through its factors"""
+        self.codebook1 = codebook1
+        self.codebook2 = codebook2
+        self.operator1 = codebook_operator(codebook1)
+        self.operator2 = codebook_operator(codebook2)
+        self.shape = (codebook1.shape[0]*codebook2.shape[0], codebook1.shape[1]*codebook2.shape[1])
+    def apply(self, x, axis, bool_conj=False):
+        (N1, M1), (N2, M2) = self.codebook1.shape, self.codebook2.shape
+        axis = axis % np.ndim(x)
+        x = np.reshape(x, np.shape(x)[:axis] + (N1, N2) + np.shape(x)[axis+1:])
+        x = self.operator1.apply(x, axis, bool_conj)
+        x = self.operator2.apply(x, axis+1, bool_conj)
+        return np.reshape(x, x.shape[:axis] + (M1*M2,) + x.shape[axis+2:])
+    def cost(self):
+        (N1, M1), (N2, M2) = self.codebook1.shape, self.codebook2.shape
+        return self.operator1.cost()*N2 + M1*self.operator2.cost()
+    def dense(self):
+        return np.kron(self.codebook1, self.codebook2)
+
+def reduced_codebook(N, n, overlap=True):
+    """(N, n) codebook of n sinc-tapered beams evenly spread in phase, each 2*pi/n wide (plus pi/N if overlap)"""
+    if overlap:
+        width = 2*np.pi/n+np.pi/N
+    else:
+        width = 2*np.pi/n
+    bp = np.sinc((width/(2*np.pi))*(np.arange(N)-(N-1)/2))
+    bp /= np.linalg.norm(bp)
+    angles = np.linspace(0, 2*np.pi, n, endpoint = False)
+    return bp[:, np.newaxis]*np.exp(1j*np.arange(N)[:, np.newaxis]*angles[np.newaxis, :])
 
 ### Basic antenna class
 class Antenna():
-    def __init__(self, antenna_elements, uncertainty=pywarraychannels.uncertainties.Static(), z_positive=False):
-        """Example: Antenna([[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0]])"""
+    grid_cache_elements = 2**24     # Bound on the entries of the cached steering/array factor grids
+    def __init__(self, antenna_elements, uncertainty=None, z_positive=False, dtype="complex"):
+        """Example: Antenna([[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0]])
+        Steering vectors and codebooks are kept in dtype (e.g. "complex64" for single precision)"""
         self.antenna_elements = np.array(antenna_elements)
-        self.uncertainty = uncertainty
+        # A Static per antenna, update_uncertainty(n) gives it a batch of orientations
+        self.uncertainty = pywarraychannels.uncertainties.Static() if uncertainty is None else uncertainty
+        self.dtype = np.dtype(dtype)
+        self.grids = {}
+        self.codebook_version = 0
         self.set_codebook(sfft.fft(np.eye(len(antenna_elements)))/np.sqrt(len(antenna_elements)))
         self.z_positive = z_positive
     def scalar_dir(self, dir):
@@ -20,25 +118,91 @@ class Antenna():
         dir = self.uncertainty.apply_inverse(dir)
         return np.dot(dir, self.antenna_elements.T)
     def steering_vector(self, dir):
-        sdir = self.scalar_dir(dir) * np.pi
+        # The phases are computed in double precision, element projections reach many cycles
+        steering = self.__steering__(dir).astype(self.dtype, copy=False)
         if self.z_positive:
             dir = np.array(dir)
             dir = self.uncertainty.apply_inverse(dir)
-            if len(dir.shape) == 1:
-                return ne.evaluate("cos(sdir)+1j*sin(sdir)")*(dir[2] >= 0)
-            else:
-                return ne.evaluate("cos(sdir)+1j*sin(sdir)")*(dir[..., 2] >= 0)[..., np.newaxis]
+            return steering*(dir[..., 2] >= 0)[..., np.newaxis]
         else:
-            return ne.evaluate("cos(sdir)+1j*sin(sdir)")
+            return steering
+    def __steering__(self, dir):
+        sdir = self.scalar_dir(dir) * np.pi
+        return pywarraychannels.backends.evaluate("cos(sdir)+1j*sin(sdir)", {"sdir": sdir})
     def array_factor(self, dir):
-        return np.dot(np.conj(self.steering_vector(dir)), self.codebook)
-    def update_uncertainty(self):
-        self.uncertainty.update()
+        return self.codebook_operator().apply(np.conj(self.steering_vector(dir)), -1)
+    def steering_grid(self, n_azimuth=360, n_elevation=181):
+        """Steering vectors (n_elevation, n_azimuth, N) on the grid azimuth in [-pi, pi), elevation in [-pi/2, pi/2],
+        cached until the uncertainty updates"""
+        return self.__grid__(n_azimuth, n_elevation)["steering"]
+    def array_factor_grid(self, n_azimuth=360, n_elevation=181):
+        """array_factor (n_elevation, n_azimuth, M) on the grid of steering_grid, cached until the codebook changes"""
+        grid = self.__grid__(n_azimuth, n_elevation)
+        if grid["codebook_version"] != self.codebook_version:
+            grid["array_factor"] = self.codebook_operator().apply(np.conj(grid["steering"]), -1)
+            grid["codebook_version"] = self.codebook_version
+            self.__bound_grids__((n_azimuth, n_elevation))
+        return grid["array_factor"]
+    def array_factor_interp(self, dir, n_azimuth=360, n_elevation=181):
+        """array_factor bilinearly interpolated from array_factor_grid, accurate while the grid step is small
+        compared to the beamwidth (about 2/N radians)"""
+        array_factor = self.array_factor_grid(n_azimuth, n_elevation)
+        dir = np.array(dir)
+        azimuth, elevation = pywarraychannels.em.cartesian2polar(dir/np.linalg.norm(dir, axis = -1)[..., np.newaxis])
+        u = (azimuth + np.pi)*n_azimuth/(2*np.pi)
+        v = (elevation + np.pi/2)*(n_elevation-1)/np.pi
+        i0 = np.floor(u).astype(int)
+        j0 = np.clip(np.floor(v).astype(int), 0, n_elevation-2)
+        fu, fv = (u - i0)[..., np.newaxis], (v - j0)[..., np.newaxis]
+        i0, i1 = i0 % n_azimuth, (i0 + 1) % n_azimuth
+        return (1-fv)*((1-fu)*array_factor[..., j0, i0, :] + fu*array_factor[..., j0, i1, :]) + \
+            fv*((1-fu)*array_factor[..., j0+1, i0, :] + fu*array_factor[..., j0+1, i1, :])
+    def __grid__(self, n_azimuth, n_elevation):
+        key = (n_azimuth, n_elevation)
+        versions = (id(self.uncertainty), getattr(self.uncertainty, "version", None))
+        grid = self.grids.get(key)
+        if grid is None or grid["versions"] != versions:
+            azimuth = np.linspace(-np.pi, np.pi, n_azimuth, endpoint = False)
+            elevation = np.linspace(-np.pi/2, np.pi/2, n_elevation)
+            dirs = pywarraychannels.em.polar2cartesian(*np.meshgrid(azimuth, elevation))
+            grid = {"versions": versions, "steering": self.steering_vector(dirs), "codebook_version": None}
+            self.grids.pop(key, None)
+            self.grids[key] = grid
+            self.__bound_grids__(key)
+        return grid
+    def __bound_grids__(self, key):
+        # Drop the oldest grids (other than key) while the cache is above grid_cache_elements
+        size = lambda grid: grid["steering"].size + (grid["array_factor"].size if "array_factor" in grid else 0)
+        for old in list(self.grids):
+            if sum(size(grid) for grid in self.grids.values()) <= self.grid_cache_elements:
+                break
+            if old != key:
+                del self.grids[old]
+    def update_uncertainty(self, n=None):
+        """With n, sample n orientations at once, steering vectors then get a leading orientation axis.
+        Both antennas of a channel move in lockstep, batches of RX and TX orientations must have the same n."""
+        if n is None:
+            self.uncertainty.update()
+        else:
+            self.uncertainty.update(n)
+    @property
+    def codebook(self):
+        return self.__codebook__
+    @codebook.setter
+    def codebook(self, codebook):
+        # Every codebook change bumps the version so cached measurement plans get invalidated
+        self.__codebook__ = None if codebook is None else np.asarray(codebook, dtype=self.dtype)
+        self.codebook_version += 1
     def set_codebook(self, codebook):
         codebook = codebook/np.maximum(np.linalg.norm(codebook, ord = 2, axis = 0)[np.newaxis, ...], 1e-8)
         self.codebook = codebook
     def codebook_corr(self):
         return np.dot(np.conj(self.codebook.T), self.codebook)
+    def codebook_operator(self):
+        """Operator applying the codebook, with FFTs when it's a DFT codebook"""
+        if getattr(self, "operator_version", None) != self.codebook_version:
+            self.operator, self.operator_version = codebook_operator(self.codebook), self.codebook_version
+        return self.operator
 
 ### Basic antenna classes
 class LinearAntenna(Antenna):
@@ -49,14 +213,7 @@ class LinearAntenna(Antenna):
         self.N_antennas = N_antennas
         self.codebook = sfft.fft(np.eye(N_antennas))/np.sqrt(N_antennas)
     def set_reduced_codebook(self, n, overlap = True):
-        if overlap:
-            width = 2*np.pi/n+np.pi/self.N_antennas
-        else:
-            width = 2*np.pi/n
-        bp = np.sinc((width/(2*np.pi))*(np.arange(self.N_antennas)-(self.N_antennas-1)/2))
-        bp /= np.linalg.norm(bp)
-        angles = np.linspace(0, 2*np.pi, n, endpoint = False)
-        self.set_codebook(bp[:, np.newaxis]*np.exp(1j*np.arange(self.N_antennas)[:, np.newaxis]*angles[np.newaxis, :]))
+        self.set_codebook(reduced_codebook(self.N_antennas, n, overlap))
 
 class RectangularAntenna(Antenna):
     def __init__(self, N_antennas, dir=([1, 0, 0], [0, 1, 0]), *args, **kwargs):
@@ -65,30 +222,53 @@ class RectangularAntenna(Antenna):
         grid_y, grid_x = np.meshgrid(np.arange(N_antennas[1]), np.arange(N_antennas[0]))
         grid_x, grid_y = np.ndarray.flatten(grid_x), np.ndarray.flatten(grid_y)
         grid = np.array([grid_x, grid_y]).T
+        self.cdb1, self.cdb2 = None, None
         super(RectangularAntenna, self).__init__(np.dot(grid, dir), *args, **kwargs)
         self.N_antennas = N_antennas
+        self.dir = dir
         self.set_pair_codebook(sfft.fft(np.eye(N_antennas[0])), sfft.fft(np.eye(N_antennas[1])))
+    def __steering__(self, dir):
+        # The steering vector of the grid is the Kronecker product of the ones along each axis
+        dir = np.array(dir)
+        if len(dir.shape) == 1:
+            dir = dir/np.linalg.norm(dir)
+        else:
+            dir = dir/np.linalg.norm(dir, axis = -1)[..., np.newaxis]
+        dir = self.uncertainty.apply_inverse(dir)
+        sdir = np.dot(dir, self.dir.T) * np.pi
+        sdir1 = sdir[..., 0:1]*np.arange(self.N_antennas[0])
+        sdir2 = sdir[..., 1:2]*np.arange(self.N_antennas[1])
+        steering1 = pywarraychannels.backends.evaluate("cos(sdir1)+1j*sin(sdir1)", {"sdir1": sdir1})
+        steering2 = pywarraychannels.backends.evaluate("cos(sdir2)+1j*sin(sdir2)", {"sdir2": sdir2})
+        return np.reshape(steering1[..., :, np.newaxis]*steering2[..., np.newaxis, :], sdir.shape[:-1] + (-1,))
+    @property
+    def codebook(self):
+        # The dense codebook of a pair codebook is only materialized when accessed
+        if self.__codebook__ is None and self.cdb1 is not None:
+            self.__codebook__ = np.kron(self.cdb1, self.cdb2)
+        return self.__codebook__
+    @codebook.setter
+    def codebook(self, codebook):
+        Antenna.codebook.fset(self, codebook)
     def set_pair_codebook(self, cdb1, cdb2):
         cdb1 = cdb1/np.linalg.norm(cdb1, ord = 2, axis = 0)[np.newaxis, ...]
         cdb2 = cdb2/np.linalg.norm(cdb2, ord = 2, axis = 0)[np.newaxis, ...]
-        self.cdb1 = cdb1
-        self.cdb2 = cdb2
-        super(RectangularAntenna, self).set_codebook(np.kron(cdb1, cdb2))
+        self.cdb1 = cdb1.astype(self.dtype, copy=False)
+        self.cdb2 = cdb2.astype(self.dtype, copy=False)
+        self.codebook = None
     def set_codebook(self, codebook):
         self.cdb1 = None
         self.cdb2 = None
         super(RectangularAntenna, self).set_codebook(codebook)
+    def codebook_corr(self):
+        if self.cdb1 is None:
+            return super(RectangularAntenna, self).codebook_corr()
+        return np.kron(np.dot(np.conj(self.cdb1.T), self.cdb1), np.dot(np.conj(self.cdb2.T), self.cdb2))
+    def codebook_operator(self):
+        if self.cdb1 is None:
+            return super(RectangularAntenna, self).codebook_operator()
+        if getattr(self, "operator_version", None) != self.codebook_version:
+            self.operator, self.operator_version = KroneckerCodebook(self.cdb1, self.cdb2), self.codebook_version
+        return self.operator
     def set_reduced_codebook(self, n, overlap=True):
-        if overlap:
-            width1, width2 = 2*np.pi/n[0]+np.pi/self.N_antennas[0], 2*np.pi/n[1]+np.pi/self.N_antennas[1]
-        else:
-            width1, width2 = 2*np.pi/n[0], 2*np.pi/n[1]
-        bp1 = np.sinc((width1/(2*np.pi))*(np.arange(self.N_antennas[0])-(self.N_antennas[0]-1)/2))
-        bp2 = np.sinc((width2/(2*np.pi))*(np.arange(self.N_antennas[1])-(self.N_antennas[1]-1)/2))
-        bp1 /= np.linalg.norm(bp1)
-        bp2 /= np.linalg.norm(bp2)
-        angles1 = np.linspace(0, 2*np.pi, n[0], endpoint = False)
-        angles2 = np.linspace(0, 2*np.pi, n[1], endpoint = False)
-        cdb1 = bp1[:, np.newaxis]*np.exp(1j*np.arange(self.N_antennas[0])[:, np.newaxis]*angles1[np.newaxis, :])
-        cdb2 = bp2[:, np.newaxis]*np.exp(1j*np.arange(self.N_antennas[1])[:, np.newaxis]*angles2[np.newaxis, :])
-        self.set_pair_codebook(cdb1, cdb2)
+        self.set_pair_codebook(reduced_codebook(self.N_antennas[0], n[0], overlap), reduced_codebook(self.N_antennas[1], n[1], overlap))
@@ -0,0 +1,63 @@
+import numpy as np
+import importlib
+
+### Auxiliar
+# Imported backends, None for those that aren't installed
+__modules__ = {}
+# Functions of the numexpr expressions evaluated with NumPy when numexpr isn't installed
+__functions__ = {"__builtins__": {}, "cos": np.cos, "sin": np.sin, "exp": np.exp, "conj": np.conj, "abs": np.abs, "floor": np.floor, "where": np.where}
+__compiled__ = {}
+
+def module(name):
+    """The module name imported on first use, None if it isn't installed"""
+    if name not in __modules__:
+        try:
+            __modules__[name] = importlib.import_module(name)
+        except ImportError:
+            __modules__[name] = None
+    return __modules__[name]
+
+def available(name):
+    return module(name) is not None
+
+def evaluate(expression, local_dict):
+    """numexpr.evaluate(expression, local_dict), evaluated with NumPy if numexpr isn't installed"""
+    ne = module("numexpr")
+    if ne is not None:
+        return ne.evaluate(expression, local_dict=local_dict)
+    if expression not in __compiled__:
+        __compiled__[expression] = compile(expression, "<expression>", "eval")
+    return eval(__compiled__[expression], __functions__, dict(local_dict))
+
+### Fallbacks
+class NumpyFFT():
+    """The scipy.fft functions used by the package, on numpy.fft"""
+    fft = staticmethod(np.fft.fft)
+    ifft = staticmethod(np.fft.ifft)
+    @staticmethod
+    def next_fast_len(n):
+        """Smallest 2**a*3**b*5**c not below n"""
+        best, power5 = 2*n, 1
+        while power5 < best:
+            power35 = power5
+            while power35 < best:
+                length = power35*2**max(int(np.ceil(np.log2(n/power35))), 0)
+                best = min(best, length)
+                power35 *= 3
+            power5 *= 5
+        return best
+
+### Lazy module class
+class LazyModule():
+    def __init__(self, name, fallback=None):
+        """Stand-in for the module name (e.g. sfft = LazyModule("scipy.fft")), imported on first attribute
+        access, or fallback (an object with the same attributes) if it isn't installed"""
+        self.__name = name
+        self.__fallback = fallback
+    def __getattr__(self, attribute):
+        loaded = module(self.__name)
+        if loaded is None:
+            if self.__fallback is None:
+                raise ImportError("{} is required for {}".format(self.__name, attribute))
+            loaded = self.__fallback
+        return getattr(loaded, attribute)
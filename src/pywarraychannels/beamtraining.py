@@ -0,0 +1,125 @@
+import numpy as np
+import pywarraychannels.antennas
+import pywarraychannels.channels
+
+# Auxiliar
+def __axis_sizes__(branch, n_final):
+    """Beams of the levels of one axis: branch, branch**2, ... up to n_final"""
+    sizes = [min(branch, n_final)]
+    while sizes[-1] < n_final:
+        sizes.append(min(sizes[-1]*branch, n_final))
+    return sizes
+
+def __children__(n, n_child):
+    """Beams of the n_child level whose centre falls within the span of each beam of the n level"""
+    if n_child == n:
+        return [np.array([m]) for m in range(n)]
+    centres = np.arange(n_child)/n_child
+    children = []
+    for m in range(n):
+        distance = np.abs((centres - m/n + 0.5) % 1 - 0.5)
+        children.append(np.nonzero(distance <= 0.5/n + 1e-12)[0])
+    return children
+
+### Codebook tree
+class CodebookTree():
+    def __init__(self, antenna, branch=2, n_final=None, overlap=True):
+        """Levels of reduced codebooks of the antenna (pywarraychannels.antennas.reduced_codebook), each with
+        branch times more beams per axis than the previous one, up to n_final beams per axis (the number of
+        antennas by default). Rectangular antennas get one tree per axis, their beams are the pairs of beams."""
+        N = np.atleast_1d(antenna.N_antennas)
+        n_final = N if n_final is None else np.broadcast_to(n_final, N.shape)
+        sizes = [__axis_sizes__(branch, n) for n in n_final]
+        self.n_levels = max(len(s) for s in sizes)
+        # Axes with fewer levels stay at their finest codebook
+        self.sizes = [[s[min(l, len(s)-1)] for s in sizes] for l in range(self.n_levels)]
+        self.codebooks = [[pywarraychannels.antennas.reduced_codebook(N_a, n, overlap).astype(antenna.dtype) for N_a, n in zip(N, level)] for level in self.sizes]
+        self.children_axes = [[__children__(n, n_child) for n, n_child in zip(self.sizes[l], self.sizes[l+1])] for l in range(self.n_levels-1)]
+    def n_beams(self, level):
+        return int(np.prod(self.sizes[level]))
+    def columns(self, level, beams):
+        """(N, len(beams)) codebook columns of the beams of a level"""
+        indices = np.unravel_index(np.asarray(beams), self.sizes[level])
+        columns = self.codebooks[level][0][:, indices[0]]
+        for codebook, index in zip(self.codebooks[level][1:], indices[1:]):
+            columns = (columns[:, np.newaxis, :]*codebook[np.newaxis, :, index]).reshape(-1, len(index))
+        return columns
+    def children(self, level, beams):
+        """Beams of the next level refining the given beams of level"""
+        children = []
+        for beam in np.atleast_1d(beams):
+            indices = np.unravel_index(beam, self.sizes[level])
+            axes = [children_axis[index] for children_axis, index in zip(self.children_axes[level], indices)]
+            children.append(np.ravel_multi_index(tuple(np.meshgrid(*axes, indexing="ij")), self.sizes[level+1]).ravel())
+        return np.unique(np.concatenate(children))
+
+### Beam training class
+class BeamTraining():
+    def __init__(self, channel, branch=2, n_best=1, n_final=None, overlap=True, noise=0, n_rf_RX=1, rng=None):
+        """Hierarchical beam search over the codebook trees of both antennas of channel (a Geometric channel or
+        any wrapper of one), reusing its built (N_RX, N_TX, D) channel tensor. Every level probes all pairs of
+        the children of the n_best beam pairs of the previous one, a probe being the energy over the taps of
+        the projection on a pair of beams, with complex noise of variance noise per tap. The RX sweeps n_rf_RX
+        beams per slot."""
+        self.geometric = pywarraychannels.channels.base_channel(channel)
+        self.tree_RX = CodebookTree(self.geometric.antenna_RX, branch, n_final, overlap)
+        self.tree_TX = CodebookTree(self.geometric.antenna_TX, branch, n_final, overlap)
+        self.n_levels = max(self.tree_RX.n_levels, self.tree_TX.n_levels)
+        self.n_best = n_best
+        self.noise = noise
+        self.n_rf_RX = n_rf_RX
+        self.rng = np.random if rng is None else np.random.default_rng(rng)
+    def __level__(self, tree, level):
+        # The tree with fewer levels repeats its last one
+        return min(level, tree.n_levels-1)
+    def __energy__(self, level, beams_RX, beams_TX):
+        meas = pywarraychannels.channels.project(
+            self.geometric.channel,
+            self.tree_RX.columns(self.__level__(self.tree_RX, level), beams_RX),
+            self.tree_TX.columns(self.__level__(self.tree_TX, level), beams_TX), None)
+        return np.sum(np.abs(meas)**2, axis=-1), meas
+    def measure(self):
+        """Run the search, returns {"beam_RX", "beam_TX" (indices in the finest codebooks), "gain" (noiseless
+        energy of the chosen pair), "measurements", "slots", "levels" (beams probed and best energy per level)}"""
+        beams_RX = np.arange(self.tree_RX.n_beams(0))
+        beams_TX = np.arange(self.tree_TX.n_beams(0))
+        measurements, slots, levels = 0, 0, []
+        for level in range(self.n_levels):
+            energy, meas = self.__energy__(level, beams_RX, beams_TX)
+            if self.noise:
+                noise = pywarraychannels.channels.complex_normal(self.rng, meas.shape, meas.dtype, np.sqrt(self.noise/2))
+                energy = np.sum(np.abs(meas + noise)**2, axis=-1)
+            measurements += energy.size
+            slots += int(np.ceil(len(beams_RX)/self.n_rf_RX))*len(beams_TX)
+            best = np.argsort(energy, axis=None)[::-1][:self.n_best]
+            best_RX, best_TX = np.unravel_index(best, energy.shape)
+            levels.append({"beams_RX": len(beams_RX), "beams_TX": len(beams_TX), "energy": float(energy[best_RX[0], best_TX[0]])})
+            if level == self.n_levels-1:
+                break
+            beams_RX = self.__refine__(self.tree_RX, level, beams_RX[best_RX])
+            beams_TX = self.__refine__(self.tree_TX, level, beams_TX[best_TX])
+        gain, _ = self.__energy__(level, beams_RX[best_RX[:1]], beams_TX[best_TX[:1]])
+        return {
+            "beam_RX": int(beams_RX[best_RX[0]]),
+            "beam_TX": int(beams_TX[best_TX[0]]),
+            "gain": float(gain[0, 0]),
+            "measurements": measurements,
+            "slots": slots,
+            "levels": levels}
+    def __refine__(self, tree, level, beams):
+        if level+1 >= tree.n_levels:
+            return np.unique(beams)
+        return tree.children(level, np.unique(beams))
+    def exhaustive(self):
+        """Best pair of the finest codebooks by probing all of them, same keys as measure (without levels)"""
+        level = self.n_levels-1
+        energy, _ = self.__energy__(level,
+            np.arange(self.tree_RX.n_beams(self.__level__(self.tree_RX, level))),
+            np.arange(self.tree_TX.n_beams(self.__level__(self.tree_TX, level))))
+        beam_RX, beam_TX = np.unravel_index(np.argmax(energy), energy.shape)
+        return {
+            "beam_RX": int(beam_RX),
+            "beam_TX": int(beam_TX),
+            "gain": float(energy[beam_RX, beam_TX]),
+            "measurements": energy.size,
+            "slots": int(np.ceil(energy.shape[0]/self.n_rf_RX))*energy.shape[1]}
@@ -1,11 +1,132 @@
 import numpy as np
-import numexpr as ne
+import pywarraychannels.backends
 import pywarraychannels.filters
-import scipy.ndimage as sndimage
+import pywarraychannels.em
+import pywarraychannels.antennas
+import pywarraychannels.profiling
+import concurrent.futures
+
+sfft = pywarraychannels.backends.LazyModule("scipy.fft", pywarraychannels.backends.NumpyFFT)
+
+### Auxiliar
+def project(channel, codebook_RX, codebook_TX, signal, mode="Pairs"):
+    """Measure a (..., N_RX, N_TX, D) channel with the given codebooks, leading axes are kept as batch axes.
+    The result is convolved with signal along the last axis unless signal is None."""
+    return MeasurementPlan(codebook_RX, codebook_TX, signal, mode).apply(channel)
+
+def convolve(meas, signal):
+    """Causal convolution of the taps (last axis) with signal, the result has len(signal)-1 extra taps"""
+    pad = [(0, 0)]*(meas.ndim-1) + [(len(signal)-1, 0)]
+    sndimage = pywarraychannels.backends.module("scipy.ndimage")
+    if sndimage is not None:
+        return sndimage.convolve1d(np.pad(meas, pad), signal, axis = -1)
+    # Same centred window as scipy.ndimage, which reflects the last len(signal)//2 taps
+    signal = np.asarray(signal)
+    L, shift, T = len(signal), len(signal)//2, meas.shape[-1]+len(signal)-1
+    extended = np.pad(np.pad(meas, pad), [(0, 0)]*(meas.ndim-1) + [(0, shift)], mode="symmetric")
+    extended = np.pad(extended, [(0, 0)]*(meas.ndim-1) + [(L-1, 0)])
+    result = np.zeros(meas.shape[:-1] + (T,), dtype=np.result_type(meas, signal))
+    for j in range(L):
+        result += signal[j]*extended[..., shift+L-1-j:shift+L-1-j+T]
+    return result
+
+class MeasurementPlan():
+    fft_threshold = 64      # Signal length from which the convolution goes through FFTs
+    def __init__(self, codebook_RX, codebook_TX, signal, mode="Pairs"):
+        """Codebook operators and convolution of a measurement, computed once for repeated measures.
+        Codebooks are either arrays or operators from Antenna.codebook_operator."""
+        self.mode = mode
+        operator_RX, operator_TX = [
+            codebook if hasattr(codebook, "apply") else pywarraychannels.antennas.DenseCodebook(codebook)
+            for codebook in [codebook_RX, codebook_TX]]
+        (N_RX, M_RX), (N_TX, M_TX) = operator_RX.shape, operator_TX.shape
+        if mode == "Pairs":
+            self.operator_RX = operator_RX
+            self.operator_TX = operator_TX
+            # Contract first the side that leads to the fewest multiplications
+            self.bool_RX_first = operator_RX.cost()*N_TX + operator_TX.cost()*M_RX <= operator_TX.cost()*N_RX + operator_RX.cost()*M_TX
+        elif mode == "Sequential":
+            self.operator = operator_TX.dense()[np.newaxis, :, :]*np.conj(operator_RX.dense())[:, np.newaxis, :]
+        else:
+            print("Measure mode {} not recognized".format(mode))
+            raise
+        self.signal = None if signal is None else np.asarray(signal)
+        self.signal_fft = {}
+    def apply(self, channel):
+        rx_c_tx = pywarraychannels.profiling.call("codebooks", self.codebooks, channel)
+        return pywarraychannels.profiling.call("convolve", self.convolve, rx_c_tx)
+    def codebooks(self, channel):
+        """Codebook contraction of the RX and TX axes, without convolution"""
+        if self.mode == "Pairs":
+            if self.bool_RX_first:
+                return self.operator_TX.apply(self.operator_RX.apply(channel, -3, bool_conj=True), -2)
+            return self.operator_RX.apply(self.operator_TX.apply(channel, -2), -3, bool_conj=True)
+        return np.moveaxis(np.tensordot(self.operator, channel, axes = ([0, 1], [-3, -2])), 0, -2)
+    def convolve(self, meas):
+        if self.signal is None:
+            return meas
+        if len(self.signal) < self.fft_threshold:
+            return convolve(meas, self.signal)
+        # Same result as convolve (scipy.ndimage's centred window reflects the last len(signal)//2 taps)
+        L, shift = len(self.signal), len(self.signal)//2
+        extended = np.pad(meas, [(0, 0)]*(meas.ndim-1) + [(L-1, 0)])
+        extended = np.pad(extended, [(0, 0)]*(meas.ndim-1) + [(0, shift)], mode="symmetric")
+        n = sfft.next_fast_len(extended.shape[-1] + L - 1)
+        if n not in self.signal_fft:
+            self.signal_fft[n] = sfft.fft(self.signal, n)
+        full = sfft.ifft(sfft.fft(extended, n, axis = -1)*self.signal_fft[n], axis = -1)
+        return full[..., shift:shift+meas.shape[-1]+L-1]
+
+def standard_normal(rng, shape, dtype=float):
+    """Standard normal samples of a real dtype from a numpy.random.Generator (drawn in dtype) or the numpy.random module"""
+    if isinstance(rng, np.random.Generator):
+        return rng.standard_normal(shape, dtype=dtype)
+    return rng.standard_normal(shape).astype(dtype, copy=False)
+
+def complex_normal(rng, shape, dtype=complex, sigma=1):
+    """Complex normal samples with standard deviation sigma per real dimension, drawn in one pass"""
+    real_dtype = np.finfo(dtype).dtype
+    noise = standard_normal(rng, tuple(shape) + (2,), real_dtype)
+    if sigma != 1:
+        noise *= real_dtype.type(sigma)
+    return noise.view(dtype)[..., 0]
+
+class ThreadLimits():
+    def __init__(self, numexpr_threads=None, blas_threads=None):
+        """Context setting the numexpr and BLAS thread pools (None leaves a pool as it is), BLAS needs threadpoolctl"""
+        self.numexpr_threads = numexpr_threads
+        self.blas_threads = blas_threads
+        self.previous, self.limits = None, None
+    def __enter__(self):
+        ne = pywarraychannels.backends.module("numexpr")
+        if self.numexpr_threads is not None and ne is not None:
+            self.previous = ne.set_num_threads(self.numexpr_threads)
+        if self.blas_threads is not None:
+            threadpoolctl = pywarraychannels.backends.module("threadpoolctl")
+            if threadpoolctl is None:
+                raise ImportError("Limiting the BLAS threads requires threadpoolctl")
+            self.limits = threadpoolctl.threadpool_limits(limits=self.blas_threads, user_api="blas")
+        return self
+    def __exit__(self, *exc):
+        if self.limits is not None:
+            self.limits.restore_original_limits()
+            self.limits = None
+        if self.previous is not None:
+            pywarraychannels.backends.module("numexpr").set_num_threads(self.previous)
+            self.previous = None
+        return False
+
+def base_channel(channel):
+    """Walk down the wrapper chain (AWGN, Rician, MIMO, ...) to the geometric channel"""
+    while hasattr(channel, "channel_dependency"):
+        channel = channel.channel_dependency
+    return channel
 
 ### Channel classes
 class Geometric():
-    def __init__(self, antenna_RX, antenna_TX, K=128, f_c=60e9, B=1.760e9, filter=pywarraychannels.filters.RCFilter(), bool_sync=True):
+    def __init__(self, antenna_RX, antenna_TX, K=128, f_c=60e9, B=1.760e9, filter=pywarraychannels.filters.RCFilter(), bool_sync=True, dtype="complex"):
+        """dtype is the precision of the channel and its measurements, with "complex64" the filter responses
+        and contractions run in single precision (per-ray delays and phases are computed in double and rounded)"""
         self.antenna_RX = antenna_RX
         self.antenna_TX = antenna_TX
         self.f_c = f_c
@@ -14,129 +135,501 @@ class Geometric():
         self.f_k_rel = self.f_k/f_c
         self.filter = filter
         self.bool_sync = bool_sync
-    def build(self, rays):
-        channel = None
-        if len([ray for ray in rays]) == 0:
+        self.dtype = np.dtype(dtype)
+        self.real_dtype = np.finfo(self.dtype).dtype
+        self.max_chunk_elements = 2**18     # Bound on the (taps, rays, N_RX, N_TX) filter response evaluated at once, about 8 temporaries of that size are alive
+        self.plans, self.plans_versions = {}, None
+        self.measurements, self.measurements_channel = {}, None
+        self.rays_by_key, self.tau_ref, self.bool_batch = {}, None, False
+        self.set_threads()
+    def set_threads(self, n_threads=1, numexpr_threads=None, blas_threads=None):
+        """Threads accumulating the ray chunks of build, and numexpr/BLAS thread pools while building and
+        measuring (None leaves them as they are). With n_threads > 1 every thread accumulates a contiguous
+        block of chunks into its own buffer, which are added in thread order, so results are reproducible
+        for a given n_threads and the build takes n_threads times the channel memory."""
+        self.n_threads = n_threads
+        self.numexpr_threads = numexpr_threads
+        self.blas_threads = blas_threads
+    def thread_limits(self):
+        return ThreadLimits(self.numexpr_threads, self.blas_threads)
+    @pywarraychannels.profiling.stage()
+    def build(self, rays, chunk_size=None, keys=None):
+        """Build the (N_RX, N_TX, D) channel (with a leading axis for batched antenna orientations), keys identify the rays for later add/remove/update_rays (by default 0, 1, ...)"""
+        ray_info = self.ray_table(rays)
+        self.rays_by_key = dict(zip(range(len(ray_info)) if keys is None else keys, ray_info))
+        self.bool_batch = False
+        if len(ray_info) == 0:
+            self.tau_ref = None
             response_time = self.filter.response(len(self.f_k_rel), 0)
             scalar_doa = self.antenna_RX.scalar_dir([0, 0, 0])
             scalar_dod = self.antenna_TX.scalar_dir([0, 0, 0])
-            self.channel = np.zeros((len(scalar_doa), len(scalar_dod), len(response_time)))
+            self.channel = np.zeros(np.broadcast(scalar_doa[..., :, np.newaxis], scalar_dod[..., np.newaxis, :]).shape + (len(response_time),), dtype=self.real_dtype)
             return self.channel.copy()
-        if self.bool_sync:
-            tau_min = np.min([ray[1] for ray in rays])
+        self.tau_ref = np.min(ray_info[:, 1]) if self.bool_sync else 0
+        channel = self.__accumulate__([ray_info], chunk_size)[..., 0, :, :, :]
+        self.channel = channel
+        return channel
+    def add_rays(self, rays, keys, chunk_size=None):
+        """Add the contribution of new rays to the built channel"""
+        self.__check_incremental__()
+        ray_info = self.ray_table(rays)
+        if any(key in self.rays_by_key for key in keys):
+            raise KeyError("Rays {} already in the channel".format([key for key in keys if key in self.rays_by_key]))
+        return self.__update__(dict(zip(keys, ray_info)), {}, chunk_size)
+    def remove_rays(self, keys, chunk_size=None):
+        """Subtract the contribution of the rays with the given keys from the built channel"""
+        self.__check_incremental__()
+        return self.__update__({}, {key: self.rays_by_key[key] for key in keys}, chunk_size)
+    def update_rays(self, rays, keys, chunk_size=None):
+        """Replace the rays with the given keys by new ones (e.g. after a small move)"""
+        self.__check_incremental__()
+        ray_info = self.ray_table(rays)
+        return self.__update__(dict(zip(keys, ray_info)), {key: self.rays_by_key[key] for key in keys}, chunk_size)
+    def __check_incremental__(self):
+        if self.bool_batch:
+            raise ValueError("add/remove/update_rays aren't supported after build_batch, build a single link first")
+    @pywarraychannels.profiling.stage()
+    def __update__(self, added, removed, chunk_size=None):
+        rays_by_key = dict(self.rays_by_key)
+        for key in removed:
+            del rays_by_key[key]
+        rays_by_key.update(added)
+        ray_info = self.ray_table(list(rays_by_key.values()))
+        tau_ref = (np.min(ray_info[:, 1]) if self.bool_sync else 0) if len(ray_info) > 0 else None
+        if tau_ref is None or tau_ref != self.tau_ref:
+            # The synchronization reference moved and shifts every ray, rebuild from scratch
+            return self.build(ray_info, chunk_size, keys=list(rays_by_key.keys()))
+        delta = self.__accumulate__([self.ray_table(list(added.values())), self.ray_table(list(removed.values()))], chunk_size, tau_min=tau_ref)
+        delta = delta[..., 0, :, :, :] - delta[..., 1, :, :, :]
+        bool_cached = self.measurements_channel is self.channel
+        self.channel = self.channel + delta
+        self.rays_by_key = rays_by_key
+        # Cached measurements of the unchanged rays only need the projection of the change
+        if bool_cached:
+            for key in self.measurements:
+                self.measurements[key] = self.measurements[key] + self.plans[key].apply(delta)
+            self.measurements_channel = self.channel
+        return self.channel
+    @pywarraychannels.profiling.stage()
+    def build_batch(self, rays_batch, chunk_size=None):
+        """Build the channels of many links at once, returns a (B, N_RX, N_TX, D) array"""
+        channel = self.__accumulate__([self.ray_table(rays) for rays in rays_batch], chunk_size)
+        self.rays_by_key, self.tau_ref, self.bool_batch = {}, None, True
+        self.channel = channel
+        return channel
+    def prune(self, rays, threshold=None, top_k=None, bool_window=True):
+        """Rays (R', 7) left after dropping those more than threshold dB below the strongest, all but the top_k
+        strongest and (bool_window) those whose pulse misses every tap, and the fraction of the power reaching
+        the taps that was dropped. The tap window is only known with a truncated pulse (filter tolerance),
+        with bool_sync it's referred to the first kept ray as build would do."""
+        ray_info = self.ray_table(rays)
+        if len(ray_info) == 0:
+            return ray_info, 0.
+        keep = np.ones(len(ray_info), dtype=bool)
+        if threshold is not None:
+            keep &= ray_info[:, 2] >= np.max(ray_info[:, 2]) - threshold
+        if top_k is not None:
+            keep[np.argsort(-ray_info[:, 2], kind="stable")[top_k:]] = False
+        in_window = np.ones(len(ray_info), dtype=bool)
+        support = self.filter.support() if hasattr(self.filter, "support") else np.inf
+        if bool_window and np.isfinite(support) and np.any(keep):
+            tau_min = np.min(ray_info[keep, 1]) if self.bool_sync else 0
+            # The delay also varies across the elements of the arrays
+            spread = (np.max(np.linalg.norm(self.antenna_RX.antenna_elements, axis=-1)) + np.max(np.linalg.norm(self.antenna_TX.antenna_elements, axis=-1)))*self.B/self.f_c
+            delay = (ray_info[:, 1]-tau_min)*self.B + self.filter.early_samples
+            D = len(self.f_k_rel) + self.filter.early_samples + self.filter.late_samples
+            in_window = (delay + support + spread >= 0) & (delay - support - spread <= D-1)
+        power = np.power(10, (ray_info[:, 2]-30)/10)*in_window
+        return ray_info[keep & in_window], np.sum(power[~keep])/np.sum(power)
+    def ray_table(self, rays):
+        return np.reshape(np.array([ray for ray in rays], dtype=float), (-1, 7))
+    def __accumulate__(self, ray_infos, chunk_size=None, tau_min=None):
+        """Channels (..., B, N_RX, N_TX, D) of B ray sets, the leading axes are the antennas' orientation batch (if any)"""
+        N_RX, N_TX = len(self.antenna_RX.antenna_elements), len(self.antenna_TX.antenna_elements)
+        T = len(self.f_k_rel)
+        D = T + self.filter.early_samples + self.filter.late_samples
+        n_rays = np.array([len(ray_info) for ray_info in ray_infos], dtype=int)
+        if np.sum(n_rays) == 0:
+            return np.zeros((len(ray_infos), N_RX, N_TX, D), dtype=self.dtype)
+        ray_info = np.concatenate(ray_infos)
+        link = np.repeat(np.arange(len(ray_infos)), n_rays)
+        if tau_min is None:
+            if self.bool_sync:
+                tau_min = np.array([np.min(r[:, 1]) if len(r) > 0 else 0 for r in ray_infos])[link]
+            else:
+                tau_min = 0
+        response_window = getattr(self.filter, "response_window", None)
+        bool_window = response_window is not None and getattr(self.filter, "tolerance", None) is not None
+        if bool_window:
+            # With a truncated pulse, chunks of rays close in delay only reach a narrow window of taps
+            order = np.lexsort((ray_info[:, 1], link))
+            ray_info, link = ray_info[order], link[order]
+            tau_min = tau_min[order] if np.ndim(tau_min) > 0 else tau_min
+            support = self.filter.support()
+            width = min(D, int(4*support) + 2)
         else:
-            tau_min = 0
-        for phase, tau, power, doa_az, doa_el, dod_az, dod_el in rays:
-            phase, doa_az, doa_el, dod_az, dod_el = np.radians(phase), np.radians(doa_az), np.radians(doa_el), np.radians(dod_az), np.radians(dod_el)   # Transform to radians
-            doa = np.array([np.cos(doa_el)*np.cos(doa_az), np.cos(doa_el)*np.sin(doa_az), np.sin(doa_el)])                                              # Create direction vectors
-            dod = np.array([np.cos(dod_el)*np.cos(dod_az), np.cos(dod_el)*np.sin(dod_az), np.sin(dod_el)])                                              # Create direction vectors
-            steering_doa = self.antenna_RX.steering_vector(doa)
-            steering_dod = self.antenna_TX.steering_vector(dod)
-            scalar_doa = self.antenna_RX.scalar_dir(doa)
-            scalar_dod = self.antenna_TX.scalar_dir(dod)
-            response_time = self.filter.response(len(self.f_k_rel), (tau-tau_min)*self.B+(scalar_doa[:, np.newaxis]-scalar_dod[np.newaxis, :])*self.B/self.f_c)
-            complex_gain = np.power(10, (power-30)/20)*np.exp(1j*phase)
-            #channel += complex_gain*np.exp(1j*np.pi*(scalar_doa[:, np.newaxis, np.newaxis]-scalar_dod[np.newaxis, :, np.newaxis])*f_k_rel[np.newaxis, np.newaxis, :])*response_time[np.newaxis, np.newaxis, :]
-            if channel is None:
-                channel = ne.evaluate("cg*sdoa*conj(sdod)*tr", global_dict = \
-                    {"cg": complex_gain, "pi": np.pi, "sdoa": steering_doa[:, np.newaxis, np.newaxis], "sdod": steering_dod[np.newaxis, :, np.newaxis], "tr": np.transpose(response_time, [1, 2, 0])}) # Equivalente optimized line
+            if response_window is None:
+                response_window = lambda T, delay: (0, self.filter.response(T, delay))
+            width = D
+        complex_gain, steering_doa, steering_dod, delay = self.ray_factors(ray_info, tau_min)
+        channel = np.zeros(delay.shape[:-3] + (len(ray_infos), N_RX, N_TX, D), dtype=self.dtype)
+        if chunk_size is None:
+            chunk_size = max(1, self.max_chunk_elements//(N_RX*N_TX*width*int(np.prod(delay.shape[:-3]))))
+            # At least one chunk per thread
+            chunk_size = min(chunk_size, max(1, -(-len(ray_info)//self.n_threads)))
+        bounds = list(range(0, len(ray_info), chunk_size))
+        if bool_window:
+            # Also split where the delays in a chunk spread over more than twice the pulse support
+            ray_delay, bounds = (ray_info[:, 1]-tau_min)*self.B, [0]
+            low = high = ray_delay[0]
+            for r in range(1, len(ray_info)):
+                low, high = min(low, ray_delay[r]), max(high, ray_delay[r])
+                if r - bounds[-1] >= chunk_size or high - low > 2*support:
+                    bounds.append(r)
+                    low = high = ray_delay[r]
+        chunks = list(zip(bounds, bounds[1:] + [len(ray_info)]))
+        def accumulate(buffer, chunks, call=pywarraychannels.profiling.call):
+            for start, stop in chunks:
+                chunk = slice(start, stop)
+                first, response_time = call("filter_response", response_window, T, delay[..., chunk, :, :])  # (taps, ..., rays, N_RX, N_TX)
+                call("accumulate", self.__accumulate_chunk__, buffer[..., first:first+len(response_time)], link[chunk], complex_gain[chunk], steering_doa[..., chunk, :], steering_dod[..., chunk, :], response_time)
+        with self.thread_limits():
+            n_threads = min(self.n_threads, len(chunks))
+            if n_threads <= 1:
+                accumulate(channel, chunks)
             else:
-                channel += ne.evaluate("cg*sdoa*conj(sdod)*tr", global_dict = \
-                    {"cg": complex_gain, "pi": np.pi, "sdoa": steering_doa[:, np.newaxis, np.newaxis], "sdod": steering_dod[np.newaxis, :, np.newaxis], "tr": np.transpose(response_time, [1, 2, 0])}) # Equivalente optimized line
-        self.channel = channel
+                pywarraychannels.profiling.call("accumulate_threads", self.__accumulate_threads__, accumulate, channel, chunks, n_threads)
         return channel
+    def __accumulate_threads__(self, accumulate, channel, chunks, n_threads):
+        # Contiguous blocks of chunks into thread-private buffers, reduced in a fixed order
+        blocks = [[chunks[n] for n in block] for block in np.array_split(np.arange(len(chunks)), n_threads)]
+        buffers = [channel] + [np.zeros_like(channel) for _ in range(n_threads-1)]
+        call = lambda name, function, *args: function(*args)
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+            for future in [executor.submit(accumulate, buffer, block, call) for buffer, block in zip(buffers, blocks)]:
+                future.result()
+        for buffer in buffers[1:]:
+            channel += buffer
+    def __accumulate_chunk__(self, channel, link_chunk, complex_gain, steering_doa, steering_dod, response_time):
+        cg, sdoa, sdod = complex_gain[:, np.newaxis, np.newaxis], steering_doa[..., :, :, np.newaxis], steering_dod[..., :, np.newaxis, :]
+        # numexpr only has double precision complex numbers
+        bool_numexpr = self.dtype == np.complex128 and pywarraychannels.backends.available("numexpr")
+        if bool_numexpr:
+            weight = pywarraychannels.backends.evaluate("cg*sdoa*conj(sdod)", local_dict = {"cg": cg, "sdoa": sdoa, "sdod": sdod})
+        else:
+            weight = cg*sdoa*np.conj(sdod)
+        if link_chunk[0] == link_chunk[-1]:
+            channel[..., link_chunk[0], :, :, :] += np.einsum("...rij,d...rij->...ijd", weight, response_time)
+        else:
+            # Rays are grouped per link, reduce each link's segment of the chunk
+            starts = np.flatnonzero(np.diff(link_chunk, prepend=-1))
+            if bool_numexpr:
+                contribution = pywarraychannels.backends.evaluate("w*tr", local_dict = {"w": weight, "tr": response_time})
+            else:
+                contribution = weight*response_time
+            channel[..., link_chunk[starts], :, :, :] += np.moveaxis(np.add.reduceat(contribution, starts, axis=-3), 0, -1)
+    def ray_factors(self, ray_info, tau_min=0):
+        """Per-ray complex gain (R,), steering vectors (..., R, N_RX), (..., R, N_TX) and tap delay (..., R, N_RX, N_TX)"""
+        complex_gain, steering_doa, steering_dod, tau, scalar_doa, scalar_dod = self.ray_components(ray_info)
+        delay = (tau-tau_min)[:, np.newaxis, np.newaxis]*self.B+(scalar_doa[..., :, :, np.newaxis]-scalar_dod[..., :, np.newaxis, :])*self.B/self.f_c
+        return complex_gain.astype(self.dtype), steering_doa.astype(self.dtype, copy=False), steering_dod.astype(self.dtype, copy=False), delay.astype(self.real_dtype, copy=False)
+    def ray_components(self, ray_info):
+        """Per-ray complex gain (R,), steering vectors (R, N_RX), (R, N_TX), time of arrival (R,) and element projections (R, N_RX), (R, N_TX)"""
+        phase, tau, power = np.radians(ray_info[:, 0]), ray_info[:, 1], ray_info[:, 2]
+        doa = pywarraychannels.em.polar2cartesian(np.radians(ray_info[:, 3]), np.radians(ray_info[:, 4]))    # Create direction vectors
+        dod = pywarraychannels.em.polar2cartesian(np.radians(ray_info[:, 5]), np.radians(ray_info[:, 6]))    # Create direction vectors
+        steering_doa = pywarraychannels.profiling.call("steering_vector", self.antenna_RX.steering_vector, doa)
+        steering_dod = pywarraychannels.profiling.call("steering_vector", self.antenna_TX.steering_vector, dod)
+        batch_RX, batch_TX = steering_doa.shape[:-2], steering_dod.shape[:-2]
+        if len(batch_RX) > 0 and len(batch_TX) > 0 and batch_RX != batch_TX:
+            raise ValueError("Orientation batches of the RX {} and TX {} antennas differ, update_uncertainty(n) of both antennas with the same n".format(batch_RX, batch_TX))
+        scalar_doa = self.antenna_RX.scalar_dir(doa)
+        scalar_dod = self.antenna_TX.scalar_dir(dod)
+        complex_gain = np.power(10, (power-30)/20)*np.exp(1j*phase)
+        return complex_gain, steering_doa, steering_dod, tau, scalar_doa, scalar_dod
+    @pywarraychannels.profiling.stage()
+    def build_frequency(self, rays, chunk_size=None):
+        """Build the (N_RX, N_TX, K) frequency response at the subcarriers f_k, as the sum over rays of
+        rank-one steering vector products per subcarrier. It's the spectrum of the tapped channel of build
+        (tap n at delay n-early_samples) without the time-domain filter evaluation."""
+        ray_info = self.ray_table(rays)
+        N_RX, N_TX = len(self.antenna_RX.antenna_elements), len(self.antenna_TX.antenna_elements)
+        K = len(self.f_k)
+        channel = np.zeros((K, N_RX, N_TX), dtype="complex")
+        if len(ray_info) > 0:
+            if self.bool_sync:
+                tau_min = np.min(ray_info[:, 1])
+            else:
+                tau_min = 0
+            complex_gain, steering_doa, steering_dod, tau, scalar_doa, scalar_dod = self.ray_components(ray_info)
+            nu = (self.f_k-self.f_c)/self.B                                                         # Baseband frequency [cycles/sample]
+            if chunk_size is None:
+                chunk_size = max(1, self.max_chunk_elements//(K*(N_RX+N_TX)))
+            # Sampling the pulse folds its spectrum, every alias is a rank-one term per ray and subcarrier
+            n_alias = int(np.ceil(self.filter.bandwidth()))
+            for nu_alias in [nu+alias for alias in range(-n_alias, n_alias+1)]:
+                spectrum = self.filter.spectrum(nu_alias)
+                if not np.any(spectrum):
+                    continue
+                gain = complex_gain[np.newaxis, :]*np.exp(-2j*np.pi*nu_alias[:, np.newaxis]*((tau-tau_min)*self.B+self.filter.early_samples)[np.newaxis, :])*spectrum[:, np.newaxis]
+                for start in range(0, len(ray_info), chunk_size):
+                    chunk = slice(start, start+chunk_size)
+                    phase_doa = pywarraychannels.backends.evaluate("sdoa*exp(-2j*pi*nu*doa*r)", local_dict = \
+                        {"sdoa": steering_doa[np.newaxis, chunk, :], "doa": scalar_doa[np.newaxis, chunk, :], "nu": nu_alias[:, np.newaxis, np.newaxis], "pi": np.pi, "r": self.B/self.f_c})
+                    phase_dod = pywarraychannels.backends.evaluate("conj(sdod)*exp(2j*pi*nu*dod*r)", local_dict = \
+                        {"sdod": steering_dod[np.newaxis, chunk, :], "dod": scalar_dod[np.newaxis, chunk, :], "nu": nu_alias[:, np.newaxis, np.newaxis], "pi": np.pi, "r": self.B/self.f_c})
+                    channel += np.matmul(np.transpose(phase_doa*gain[:, chunk, np.newaxis], [0, 2, 1]), phase_dod)
+        self.channel_frequency = np.transpose(channel, [1, 2, 0]).astype(self.dtype, copy=False)
+        return self.channel_frequency
+    def frequency_to_taps(self, channel_frequency=None):
+        """K taps (tap n at delay n-early_samples) of a (..., K) frequency response through an inverse FFT.
+        Taps beyond K fold back with alternating sign since the subcarriers are offset by half a bin."""
+        if channel_frequency is None:
+            channel_frequency = self.channel_frequency
+        K = channel_frequency.shape[-1]
+        taps = sfft.ifft(channel_frequency, axis=-1)
+        return np.exp(1j*np.pi*np.arange(K)*(1/K-1)).astype(taps.dtype)*taps
+    @pywarraychannels.profiling.stage()
+    def measure_frequency(self, signal=None, mode="Pairs"):
+        """Measure the frequency response per subcarrier, signal is the (K,) transmitted symbol per subcarrier"""
+        meas = self.plan(None, mode).apply(self.channel_frequency)
+        if signal is None:
+            return meas
+        return meas*np.asarray(signal).astype(meas.dtype, copy=False)
+    @pywarraychannels.profiling.stage()
+    def build_factored(self, rays, tolerance=1e-6):
+        """Build the channel as a Factored object, which keeps the per-ray factors instead of the dense tensor.
+        The delay across the elements of the arrays is expanded into K exponentials per ray, each one a term
+        of the Factored channel, with the fewest K keeping the pulse within tolerance (ValueError if none does).
+        K grows with the delay spread across the arrays, a few terms for a fraction of a sample."""
+        ray_info = self.ray_table(rays)
+        if self.bool_sync and len(ray_info) > 0:
+            tau_min = np.min(ray_info[:, 1])
+        else:
+            tau_min = 0
+        complex_gain, steering_doa, steering_dod, tau, scalar_doa, scalar_dod = self.ray_components(ray_info)
+        # Delays [samples] of the elements around the centre of each array
+        offset_doa, offset_dod = scalar_doa*self.B/self.f_c, scalar_dod*self.B/self.f_c
+        centre_doa = (np.max(offset_doa, axis=-1, initial=0) + np.min(offset_doa, axis=-1, initial=0))/2
+        centre_dod = (np.max(offset_dod, axis=-1, initial=0) + np.min(offset_dod, axis=-1, initial=0))/2
+        offset_doa, offset_dod = offset_doa - centre_doa[:, np.newaxis], offset_dod - centre_dod[:, np.newaxis]
+        spread = np.max(np.max(np.abs(offset_doa), axis=-1, initial=0) + np.max(np.abs(offset_dod), axis=-1, initial=0), initial=0)
+        f, x, fit = self.__spread_basis__(spread, tolerance)
+        # p(t-offset_doa+offset_dod) = sum_k psi_k(t)*exp(-2j*pi*f_k*offset_doa)*exp(2j*pi*f_k*offset_dod)
+        delay = (tau-tau_min)*self.B + centre_doa - centre_dod
+        response = self.filter.response(len(self.f_k_rel), delay[:, np.newaxis] - x[np.newaxis, :])
+        response_time = np.moveaxis(np.tensordot(response, fit, axes=(-1, 1)), 0, -1)
+        steering_doa = steering_doa[:, np.newaxis, :]*np.exp(-2j*np.pi*f[np.newaxis, :, np.newaxis]*offset_doa[:, np.newaxis, :])
+        steering_dod = steering_dod[:, np.newaxis, :]*np.exp(-2j*np.pi*f[np.newaxis, :, np.newaxis]*offset_dod[:, np.newaxis, :])
+        R, K = len(ray_info), len(f)
+        return Factored(
+            self.antenna_RX, self.antenna_TX, np.repeat(complex_gain, K).astype(self.dtype),
+            np.reshape(steering_doa, (R*K, -1)).astype(self.dtype, copy=False), np.reshape(steering_dod, (R*K, -1)).astype(self.dtype, copy=False),
+            np.reshape(response_time, (R*K, -1)).astype(self.dtype, copy=False))
+    def __spread_basis__(self, spread, tolerance):
+        """Frequencies f (K,), offsets x (X,) in [-spread, spread] and fit (K, X) such that a pulse p is
+        p(t+x') ~ sum_k psi_k(t)*exp(2j*pi*f_k*x') for any |x'| <= spread, with psi = fit @ p(t+x)"""
+        if spread == 0:
+            return np.zeros(1), np.zeros(1), np.ones((1, 1))
+        T = len(self.f_k_rel)
+        D = T + self.filter.early_samples + self.filter.late_samples
+        W = self.filter.bandwidth()
+        # Validated with the pulse centred in the taps at fractional delays
+        delay = (D-1)/2 - self.filter.early_samples + np.arange(16)/16
+        # The fit gets ill-conditioned with too many terms, give up once the error stops improving
+        best, K, K_best = np.inf, int(2*W*spread)+1, None
+        while K_best is None or K - K_best <= 8:
+            f = np.linspace(-W, W, K) if K > 1 else np.zeros(1)
+            x = np.linspace(-spread, spread, 4*K+16)
+            fit = np.linalg.pinv(np.exp(2j*np.pi*np.outer(x, f)), rcond=1e-12)
+            psi = np.tensordot(self.filter.response(T, delay[:, np.newaxis] - x[np.newaxis, :]), fit, axes=(-1, 1))
+            x_test = np.linspace(-spread, spread, 7*len(x)+3)
+            error = np.max(np.abs(np.tensordot(psi, np.exp(2j*np.pi*np.outer(f, x_test)), axes=(-1, 0)) - self.filter.response(T, delay[:, np.newaxis] - x_test[np.newaxis, :])))
+            if error <= tolerance:
+                return f, x, fit
+            if error < best:
+                best, K_best = error, K
+            K += 1
+        raise ValueError("The delay spread of {:.2f} samples across the arrays can't be factored within {:g}, the best is {:.1e}".format(spread, tolerance, best))
+    @pywarraychannels.profiling.stage()
     def measure(self, signal=None, mode="Pairs"):
         if signal is None:
             signal = [1]
+        plan = self.plan(signal, mode)
+        # Measurements are kept, with their plan's key, so add/remove/update_rays only project the change
+        if self.measurements_channel is not self.channel:
+            self.measurements, self.measurements_channel = {}, self.channel
+        if plan.key not in self.measurements:
+            with self.thread_limits():
+                self.measurements[plan.key] = plan.apply(self.channel)
+        return self.measurements[plan.key].copy()
+    def plan(self, signal, mode="Pairs"):
+        """Cached MeasurementPlan, a codebook change of either antenna invalidates it"""
+        versions = (id(self.antenna_RX), self.antenna_RX.codebook_version, id(self.antenna_TX), self.antenna_TX.codebook_version)
+        key = (mode, None if signal is None else np.asarray(signal).tobytes(), None if signal is None else np.asarray(signal).dtype.str)
+        if self.plans_versions != versions:
+            self.plans, self.plans_versions = {}, versions
+            self.measurements, self.measurements_channel = {}, None
+        if key not in self.plans:
+            if signal is not None:
+                # The signal follows the channel precision so the convolution doesn't upcast
+                signal = np.asarray(signal)
+                signal = signal.astype(self.dtype if np.iscomplexobj(signal) else self.real_dtype)
+            self.plans[key] = MeasurementPlan(self.antenna_RX.codebook_operator(), self.antenna_TX.codebook_operator(), signal, mode)
+            self.plans[key].key = key
+        return self.plans[key]
+    def __str__(self):
+        return "Geometric channel\nSize: "+"x".join([str(a) for a in np.shape(self.channel)])+"\nEntries: "+" ".join([str(a) for a in np.ndarray.flatten(self.channel)])
+
+class Factored():
+    def __init__(self, antenna_RX, antenna_TX, complex_gain, steering_doa, steering_dod, response_time):
+        """Channel sum_r complex_gain[r]*steering_doa[r, :]*conj(steering_dod[r, :])*response_time[r, :] kept in
+        factored form, taking O(terms*(N_RX+N_TX+D)) memory. Geometric.build_factored uses a few terms per ray
+        to include the delay across the elements of the arrays."""
+        self.antenna_RX = antenna_RX
+        self.antenna_TX = antenna_TX
+        self.complex_gain = complex_gain
+        self.steering_doa = steering_doa
+        self.steering_dod = steering_dod
+        self.response_time = response_time
+        self.version_RX, self.version_TX = None, None
+    def projections(self):
+        """Per-ray codebook projections (R, M_RX) and (R, M_TX), cached while the codebooks don't change"""
+        if self.version_RX != self.antenna_RX.codebook_version:
+            self.version_RX = self.antenna_RX.codebook_version
+            self.projection_RX = self.antenna_RX.codebook_operator().apply(self.steering_doa, -1, bool_conj=True)*self.complex_gain[:, np.newaxis]
+        if self.version_TX != self.antenna_TX.codebook_version:
+            self.version_TX = self.antenna_TX.codebook_version
+            self.projection_TX = self.antenna_TX.codebook_operator().apply(np.conj(self.steering_dod), -1)
+        return self.projection_RX, self.projection_TX
+    @pywarraychannels.profiling.stage()
+    def measure(self, signal=None, mode="Pairs"):
+        if signal is None:
+            signal = [1]
+        projection_RX, projection_TX = self.projections()
         if mode == "Pairs":
-            #c_tx = np.tensordot(self.antenna_TX.codebook, self.channel, axes = (0, 1))
-            #rx_c_tx = np.tensordot(np.conj(self.antenna_RX.codebook), c_tx, axes = (0, 1))
-            rx_c = np.tensordot(np.conj(self.antenna_RX.codebook), self.channel, axes = (0, 0))
-            rx_c_tx = np.tensordot(self.antenna_TX.codebook, rx_c, axes = (0, 1)).transpose((1, 0, 2))
-            return sndimage.convolve1d(np.pad(rx_c_tx, ((0, 0), (0, 0), (len(signal)-1, 0))), signal, axis = 2)
+            rx_c_tx = np.einsum("rm,rn,rt->mnt", projection_RX, projection_TX, self.response_time, optimize=True)
         elif mode == "Sequential":
-            rxtx_c = np.tensordot(self.antenna_TX.codebook[np.newaxis, :, :]*np.conj(self.antenna_RX.codebook)[:, np.newaxis, :], self.channel, axes = ([0, 1], [0, 1]))
-            return sndimage.convolve1d(np.pad(rxtx_c, ((0, 0), (len(signal)-1, 0))), signal, axis = 1)
+            rx_c_tx = np.dot((projection_RX*projection_TX).T, self.response_time)
         else:
             print("Measure mode {} not recognized".format(mode))
             raise
+        return convolve(rx_c_tx, signal)
+    def to_dense(self):
+        """(N_RX, N_TX, D) channel tensor"""
+        return np.einsum("ri,rj,rt->ijt", self.steering_doa*self.complex_gain[:, np.newaxis], np.conj(self.steering_dod), self.response_time, optimize=True)
     def __str__(self):
-        return "Geometric channel\nSize: "+"x".join([str(a) for a in np.shape(self.channel)])+"\nEntries: "+" ".join([str(a) for a in np.ndarray.flatten(self.channel)])
+        return "Factored channel\nTerms: {}\nSize: {}x{}x{}".format(len(self.complex_gain), self.steering_doa.shape[1], self.steering_dod.shape[1], self.response_time.shape[1])
 
 class MIMO():
     def __init__(self, channel_dependency, pilot=None):
         self.channel_dependency = channel_dependency
         self.pilot = pilot
+        self.pilots = {}
+        self.operators = {}
+    @pywarraychannels.profiling.stage()
     def build(self, *args, **kwargs):
         return self.channel_dependency.build(*args, **kwargs)
+    @pywarraychannels.profiling.stage()
+    def build_batch(self, *args, **kwargs):
+        return self.channel_dependency.build_batch(*args, **kwargs)
+    @pywarraychannels.profiling.stage()
     def measure(self, *args, **kwargs):
         meas_tap = self.channel_dependency.measure(*args, **kwargs)
-        M_RX, M_TX, D = meas_tap.shape
-        if self.pilot is None:
-            pilot = np.concatenate(
+        M_RX, M_TX, D = meas_tap.shape[-3:]
+        pilot = self.pilot_matrix(M_TX, D)
+        P = pilot.shape[1]
+        # meas[..., :, n] = sum_d meas_tap[..., :, :, d] @ pilot[:, n+D-1-d], a convolution along the taps
+        cached = self.operators.get((M_TX, D, meas_tap.dtype))
+        if cached is None or cached[0] is not pilot:
+            if D < MeasurementPlan.fft_threshold:
+                windows = np.lib.stride_tricks.sliding_window_view(pilot, D, axis=1)[:, :P-D, ::-1]
+                operator = np.reshape(np.transpose(windows, [0, 2, 1]), (M_TX*D, P-D))
+            else:
+                n = sfft.next_fast_len(D+P-1)
+                operator = sfft.fft(pilot, n, axis=-1)
+            cached = (pilot, operator.astype(np.result_type(meas_tap.dtype, np.complex64), copy=False))
+            self.operators[(M_TX, D, meas_tap.dtype)] = cached
+        operator = cached[1]
+        if D < MeasurementPlan.fft_threshold:
+            return np.matmul(np.reshape(meas_tap, meas_tap.shape[:-2] + (M_TX*D,)), operator)
+        n = operator.shape[-1]
+        meas = sfft.ifft(np.einsum("...jf,jf->...f", sfft.fft(meas_tap, n, axis=-1), operator), axis=-1)
+        return meas[..., D-1:P-1]
+    def pilot_matrix(self, M_TX, D):
+        """Pilot sent from the TX codebook entries, by default the DFT of the identity between D zero taps"""
+        if self.pilot is not None:
+            return self.pilot
+        if (M_TX, D) not in self.pilots:
+            self.pilots[(M_TX, D)] = np.concatenate(
                 [
                     np.zeros((M_TX, D)),
                     np.fft.fft(np.eye(M_TX)),
                     np.zeros((M_TX, D-M_TX))
                 ], axis=1)
-        else:
-            pilot = self.pilot
-        meas = np.zeros((M_RX, pilot.shape[1]-D), dtype="complex")
-        for d in range(D):
-            meas += np.dot(meas_tap[:, :, d], pilot[:, D-d-1:-d-1])
-        return meas
+        return self.pilots[(M_TX, D)]
     def __str__(self):
         return "MIMO + "+str(self.channel_dependency)
 
 class AWGN():
-    def __init__(self, channel_dependency, power=1, noise=1e-1, corr=None):
+    def __init__(self, channel_dependency, power=1, noise=1e-1, corr=None, rng=None):
         self.channel_dependency = channel_dependency
-        self.amp = np.sqrt(power)
-        self.sigma = np.sqrt(noise/2)
-        if corr is None:
-            self.L = None
-        else:
-            self.L = np.linalg.cholesky(corr)
+        self.amp = float(np.sqrt(power))
+        self.sigma = float(np.sqrt(noise/2))
+        self.rng = np.random if rng is None else np.random.default_rng(rng)
+        self.set_corr(corr)
+    @pywarraychannels.profiling.stage()
     def build(self, *args, **kwargs):
         return self.channel_dependency.build(*args, **kwargs)
-    def measure(self, *args, **kwargs):
+    @pywarraychannels.profiling.stage()
+    def build_batch(self, *args, **kwargs):
+        return self.channel_dependency.build_batch(*args, **kwargs)
+    @pywarraychannels.profiling.stage()
+    def measure(self, *args, n_realizations=None, **kwargs):
+        """With n_realizations, returns (n_realizations, ...) noisy copies of a single noiseless measurement"""
         meas = self.channel_dependency.measure(*args, **kwargs)
-        noise = self.sigma*(np.random.randn(*meas.shape)+1j*np.random.randn(*meas.shape))
-        if self.L is None:
-            return self.amp*meas + noise
-        else:
-            return self.amp*meas + np.dot(self.L, noise)
+        shape = meas.shape if n_realizations is None else (n_realizations,) + meas.shape
+        # Noise in the precision of the measurement
+        noise = pywarraychannels.profiling.call("noise", complex_normal, self.rng, shape, np.result_type(meas.dtype, np.complex64), self.sigma)
+        if self.L is not None:
+            # Correlate along the entries axis with a single product for all the other axes
+            L = self.L_by_dtype.get(noise.dtype)
+            if L is None:
+                L = self.L_by_dtype[noise.dtype] = self.L.astype(noise.dtype)
+            noise = np.moveaxis(np.tensordot(L, noise, axes=(1, -2)), 0, -2)
+        return self.amp*meas + noise
     def set_corr(self, corr=None):
         if corr is None:
             self.L = None
         else:
             self.L = np.linalg.cholesky(corr)
+        self.L_by_dtype = {}
     def __str__(self):
         return "AWGN + "+str(self.channel_dependency)
 
 class Rician():
-    def __init__(self, channel_dependency, k=1):
+    def __init__(self, channel_dependency, k=1, rng=None):
         self.channel_dependency = channel_dependency
         self.k = k
-    def build(self, *args, **kwargs):
-        main_channel =  self.channel_dependency.build(*args, **kwargs)
-        rician_component = np.random.randn(*main_channel.shape)
-        rician_component *= np.linalg.norm(main_channel)*np.sqrt(self.k)/np.linalg.norm(rician_component)
+        self.rng = np.random if rng is None else np.random.default_rng(rng)
+    @pywarraychannels.profiling.stage()
+    def build(self, *args, n_realizations=None, **kwargs):
+        """With n_realizations, returns (n_realizations, ...) channels sharing the geometric component"""
+        return self.add_component(self.channel_dependency.build(*args, **kwargs), n_realizations)
+    @pywarraychannels.profiling.stage()
+    def build_batch(self, *args, n_realizations=None, **kwargs):
+        return self.add_component(self.channel_dependency.build_batch(*args, **kwargs), n_realizations)
+    def add_component(self, main_channel, n_realizations=None):
+        shape = main_channel.shape if n_realizations is None else (n_realizations,) + main_channel.shape
+        rician_component = standard_normal(self.rng, shape, np.real(main_channel).dtype)
+        rician_component *= np.sqrt(np.sum(np.abs(main_channel)**2, axis=(-3, -2, -1), keepdims=True)*self.k)/np.sqrt(np.sum(rician_component**2, axis=(-3, -2, -1), keepdims=True))
         self.rician_component = rician_component
         return main_channel + rician_component
+    @pywarraychannels.profiling.stage()
     def measure(self, signal=None, mode="Pairs", *args, **kwargs):
         meas = self.channel_dependency.measure(signal=signal, mode=mode, *args, **kwargs)
         if signal is None:
             signal = [np.sqrt(len(self.channel_dependency.f_k_rel))]
-        if mode == "Pairs":
-            c_tx = np.tensordot(self.channel_dependency.antenna_TX.codebook, self.rician_component, axes = (0, 1))
-            rx_c_tx = np.tensordot(np.conj(self.channel_dependency.antenna_RX.codebook), c_tx, axes = (0, 1))
-            return meas + sndimage.convolve1d(np.pad(rx_c_tx, ((0, 0), (0, 0), (len(signal)-1, 0))), signal, axis = 2)
-        elif mode == "Sequential":
-            rxtx_c = np.tensordot(self.channel_dependency.antenna_TX.codebook[np.newaxis, :, :]*np.conj(self.channel_dependency.antenna_RX.codebook)[:, np.newaxis, :], self.rician_component, axes = ([0, 1], [0, 1]))
-            return meas + sndimage.convolve1d(np.pad(rxtx_c, ((0, 0), (len(signal)-1, 0))), signal, axis = 1)
-        else:
-            print("Measure mode {} not recognized".format(mode))
-            raise
+        return meas + self.channel_dependency.plan(signal, mode).apply(self.rician_component)
     def __str__(self):
         return "Rician + "+str(self.channel_dependency)
@@ -0,0 +1,120 @@
+import numpy as np
+import copy
+import multiprocessing
+import multiprocessing.util
+import os
+import pywarraychannels.em
+import pywarraychannels.channels
+import pywarraychannels.store
+
+# Auxiliar
+def sample_seed(seed, index):
+    """Seed of the random stream of a sample, independent of the worker that computes it"""
+    return np.random.SeedSequence(seed, spawn_key=(index,)).generate_state(4)
+
+def components(channel):
+    """Wrappers of the chain, the geometric channel and the uncertainties of its antennas"""
+    result = [channel]
+    while hasattr(channel, "channel_dependency"):
+        channel = channel.channel_dependency
+        result.append(channel)
+    for uncertainty in [channel.antenna_RX.uncertainty, channel.antenna_TX.uncertainty]:
+        if all(uncertainty is not component for component in result):
+            result.append(uncertainty)
+    return result
+
+def sample(channel, filename, seed, index, measure_kwargs={}, bool_update_uncertainty=True):
+    """Sample index of a dataset, every component with a generator (rng) gets its own stream of the sample.
+    The generators of the components and the global NumPy random state are restored afterwards."""
+    state = np.random.get_state()
+    with_rng = [component for component in components(channel) if hasattr(component, "rng")]
+    rngs = [component.rng for component in with_rng]
+    try:
+        np.random.seed(sample_seed(seed, index))
+        streams = np.random.SeedSequence(seed, spawn_key=(index,)).spawn(len(with_rng))
+        for component, stream in zip(with_rng, streams):
+            component.rng = np.random.default_rng(stream)
+        if bool_update_uncertainty:
+            geometric = pywarraychannels.channels.base_channel(channel)
+            geometric.antenna_RX.update_uncertainty()
+            geometric.antenna_TX.update_uncertainty()
+        channel.build(pywarraychannels.em.load(filename))
+        return channel.measure(**measure_kwargs)
+    finally:
+        for component, rng in zip(with_rng, rngs):
+            component.rng = rng
+        np.random.set_state(state)
+
+# Worker process state
+__worker__ = {}
+
+def __init_worker__(channel, output, seed, measure_kwargs, bool_update_uncertainty, item=None):
+    __worker__["channel"] = channel
+    if item is None:
+        __worker__["output"] = np.load(output, mmap_mode="r+")
+    else:
+        # Every worker appends to the store through its own writer, closed when the worker exits
+        __worker__["writer"] = pywarraychannels.store.Writer(output, *item)
+        multiprocessing.util.Finalize(None, __worker__["writer"].close, exitpriority=0)
+    __worker__["args"] = (seed, measure_kwargs, bool_update_uncertainty)
+
+def __run_worker__(job):
+    index, filename = job
+    seed, measure_kwargs, bool_update_uncertainty = __worker__["args"]
+    result = sample(__worker__["channel"], filename, seed, index, measure_kwargs, bool_update_uncertainty)
+    if "writer" in __worker__:
+        __worker__["writer"].append(result, index)
+        __worker__["writer"].flush()
+    else:
+        __worker__["output"][index] = result
+        __worker__["output"].flush()
+    return index
+
+# Generator
+def generate(filenames, channel, output, n_workers=1, seed=0, measure_kwargs={}, bool_update_uncertainty=True):
+    """Build and measure the channel for every ray file and store the stacked measurements in the .npy file output,
+    or in a store (see store.Writer) if output isn't a .npy file, with the channel metadata and the sample number as key.
+    A .npy output is overwritten, an existing store raises FileExistsError instead of getting the samples again.
+    Workers write their samples straight into the memory-mapped output and every sample draws its randomness
+    (uncertainty, Rician and AWGN) from its own stream, so the result does not depend on n_workers.
+    Example: generate(["Demos/TestRays.txt"], AWGN(Rician(Geometric(antenna_RX, antenna_TX))), "dataset.npy", n_workers=8)"""
+    filenames = list(filenames)
+    if not output.endswith(".npy") and os.path.exists(os.path.join(output, "metadata.json")):
+        raise FileExistsError("Store {} already exists, generate writes a new one".format(output))
+    # The samples build and draw on a copy, the channel of the caller is left as it is
+    channel = copy.deepcopy(channel, {id(np.random): np.random})
+    # Every sample seeds its own generators, the default one (np.random) can't be sent to the workers
+    for component in components(channel):
+        if hasattr(component, "rng"):
+            component.rng = np.random.default_rng(seed)
+    first = sample(channel, filenames[0], seed, 0, measure_kwargs, bool_update_uncertainty)
+    if output.endswith(".npy"):
+        item = None
+        data = np.lib.format.open_memmap(output, mode="w+", dtype=first.dtype, shape=(len(filenames),)+first.shape)
+        data[0] = first
+        data.flush()
+        del data
+    else:
+        item = (first.shape, first.dtype)
+        with pywarraychannels.store.Writer(output, *item, metadata=pywarraychannels.store.channel_metadata(channel, seed)) as writer:
+            writer.append(first, 0)
+    jobs = list(enumerate(filenames))[1:]
+    if n_workers > 1 and len(jobs) > 0:
+        with multiprocessing.Pool(
+                n_workers, initializer=__init_worker__,
+                initargs=(channel, output, seed, measure_kwargs, bool_update_uncertainty, item)) as pool:
+            for _ in pool.imap_unordered(__run_worker__, jobs, chunksize=max(1, len(jobs)//(4*n_workers))):
+                pass
+            # Let the workers exit on their own so that they close their writers
+            pool.close()
+            pool.join()
+    else:
+        __init_worker__(channel, output, seed, measure_kwargs, bool_update_uncertainty, item)
+        for job in jobs:
+            __run_worker__(job)
+        if "writer" in __worker__:
+            __worker__["writer"].close()
+        __worker__.clear()
+    if item is None:
+        return np.load(output, mmap_mode="r")
+    return pywarraychannels.store.Reader(output)
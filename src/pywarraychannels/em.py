@@ -1,4 +1,7 @@
 import numpy as np
+import hashlib
+import itertools
+import os
 
 # Auxiliar
 def polar2cartesian(az, el):
@@ -10,13 +13,146 @@ def cartesian2polar(v):
 def wrapangle(a):
     return np.mod(a+np.pi, 2*np.pi)-np.pi
 
+# Ray classification
+LOS, PSEUDO_LOS, FIRST_ORDER, PSEUDO_FIRST_ORDER, NLOS = range(5)
+WALL, FLOOR, CEILING = 1, 2, 4
+CLASS_NAMES = ["LoS", "pseudo-LoS", "1order", "pseudo-1order", "NLoS"]
+FLAG_NAMES = [(WALL, " (Wall)"), (FLOOR, " (Floor)"), (CEILING, " (Ceiling)")]
+
+def classify(ray_info, offsets=None):
+    """Class codes (LOS, PSEUDO_LOS, FIRST_ORDER, PSEUDO_FIRST_ORDER or NLOS) and flag bitmasks
+    (WALL | FLOOR | CEILING) of every ray, relative to the first ray of its link.
+    ray_info is a (..., R, 7) array of links with R rays each, or a (N, 7) table of consecutive
+    links starting at offsets (offsets[-1] == N)."""
+    ray_info = np.asarray(ray_info, dtype=float)
+    batch_shape = ray_info.shape[:-1]
+    if offsets is None:
+        n_rays = ray_info.shape[-2] if ray_info.ndim > 1 else 1
+        ray_info = np.reshape(ray_info, (-1, 7))
+        offsets = np.arange(0, len(ray_info)+1, max(n_rays, 1))
+    offsets = np.asarray(offsets)
+    epsilon = 1e-3
+    c = 3e8
+    codes, flags = np.full(len(ray_info), NLOS), np.zeros(len(ray_info), dtype=int)
+    if len(ray_info) == 0:
+        return np.reshape(codes, batch_shape), np.reshape(flags, batch_shape)
+    # Index of the first ray of the link of every ray
+    first = np.repeat(offsets[:-1], np.diff(offsets))
+    bool_first = first == np.arange(len(ray_info))
+    Tau = ray_info[:, 1]
+    DoA_az, DoA_el, DoD_az, DoD_el = [np.deg2rad(ray_info[:, ii]) for ii in range(3, 7)]
+    DoA = polar2cartesian(DoA_az, DoA_el)
+    DoD = polar2cartesian(DoD_az, DoD_el)
+    bool_LoS = (np.abs(DoA_el+DoD_el) < epsilon) & (np.abs(wrapangle(DoA_az-DoD_az-np.pi)) < epsilon)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cosa = np.sum(DoA*DoA[first], axis=-1)
+        cosd = np.sum(DoD*DoD[first], axis=-1)
+        sina = np.sqrt(1-cosa**2)
+        sind = np.sqrt(1-cosd**2)
+        sinad = cosa*sind + sina*cosd
+        Tau_est = Tau[first]*(sina+sind)/sinad
+        bool_1order = np.abs(Tau_est-Tau)*c < epsilon
+    codes[bool_1order] = np.where(bool_LoS[first], FIRST_ORDER, PSEUDO_FIRST_ORDER)[bool_1order]
+    codes[bool_first] = np.where(bool_LoS, LOS, PSEUDO_LOS)[bool_first]
+    flags[np.abs(DoA_el+DoD_el) < epsilon] |= WALL
+    bool_floor_ceiling = (np.abs(DoA_el-DoD_el) < epsilon) &\
+        (np.abs(wrapangle(DoA_az-DoA_az[first])) < epsilon) &\
+        (np.abs(wrapangle(DoD_az-DoD_az[first])) < epsilon)
+    flags[bool_floor_ceiling] |= np.where(DoA_el < 0, FLOOR, CEILING)[bool_floor_ceiling]
+    flags[bool_first] = 0
+    return np.reshape(codes, batch_shape), np.reshape(flags, batch_shape)
+
+def labels(codes, flags):
+    """String labels of the codes and flags from classify, e.g. pseudo-1order (Wall)"""
+    return [CLASS_NAMES[code]+"".join([name for flag, name in FLAG_NAMES if flag_ray & flag]) for code, flag_ray in zip(np.ravel(codes), np.ravel(flags))]
+
+def load(filename):
+    """Read a ray file with one ray per line (phase, tau, power, doa_az, doa_el, dod_az, dod_el)"""
+    links = load_links(filename, bool_cache=False)
+    if len(links) == 0:
+        return Geometric(np.zeros((0, 7)))
+    return links[0]
+
+def load_links(filename, link_column=None, separator=None, chunk_lines=65536, bool_cache=True):
+    """Read a ray file holding many links, returns a list of Geometric.
+    Links are told apart by the value of link_column (rays of a link are consecutive) or by
+    separator lines (lines starting with separator, or blank lines if separator is ""),
+    otherwise the whole file is one link. The file is parsed chunk_lines at a time and, if
+    bool_cache, the parsed table is kept in the sidecar files <filename>.<key>.rays.npy and
+    <filename>.<key>.links.npy (key identifies link_column and separator) so later calls with the
+    same arguments memory-map it instead of parsing the text (no cache is kept if the sidecars can't be
+    written, e.g. on a read-only mount). Cached links are read-only views of the map."""
+    key = hashlib.sha1(repr((link_column, separator)).encode()).hexdigest()[:8]
+    cache_rays, cache_links = "{}.{}.rays.npy".format(filename, key), "{}.{}.links.npy".format(filename, key)
+    if bool_cache and all(os.path.exists(f) and os.path.getmtime(f) >= os.path.getmtime(filename) for f in [cache_rays, cache_links]):
+        ray_info, offsets = np.load(cache_rays, mmap_mode="r"), np.load(cache_links)
+    else:
+        ray_info, offsets = __parse__(filename, link_column, separator, chunk_lines)
+        ray_info[:, 3:7] = np.mod(ray_info[:, 3:7]+180, 360)-180
+        if bool_cache:
+            try:
+                np.save(cache_rays, ray_info)
+                np.save(cache_links, offsets)
+            except OSError:
+                # Read-only or full file system, the links are parsed again next time
+                pass
+    return [Geometric(ray_info[start:end], bool_wrap=False) for start, end in zip(offsets[:-1], offsets[1:])]
+
+def __parse__(filename, link_column, separator, chunk_lines):
+    n_columns = 7 if link_column is None else 8
+    tables, starts = [], []
+    n_rays, link_last = 0, None
+    with open(filename) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_lines))
+            if len(lines) == 0:
+                break
+            if separator is None:
+                # Blank lines are just whitespace to the parser
+                table = np.fromstring("".join(lines), sep=" ").reshape(-1, n_columns)
+            else:
+                if separator == "":
+                    bool_sep = np.array([len(line.strip()) == 0 for line in lines])
+                else:
+                    bool_sep = np.array([line.startswith(separator) for line in lines])
+                bool_ray = np.array([len(line.strip()) > 0 for line in lines]) & ~bool_sep
+                table = np.fromstring("".join([line for line, b in zip(lines, bool_ray) if b]), sep=" ").reshape(-1, n_columns)
+            if link_column is not None and len(table) > 0:
+                # A new link starts wherever the link index changes
+                link = table[:, link_column]
+                table = np.delete(table, link_column, axis=1)
+                changes = np.flatnonzero(link[1:] != link[:-1]) + 1
+                if link_last is None or link[0] != link_last:
+                    changes = np.concatenate([[0], changes])
+                starts.extend(n_rays + changes)
+                link_last = link[-1]
+            elif separator is not None:
+                # Every separator line starts a new link
+                rays_before = np.cumsum(bool_ray) - bool_ray
+                starts.extend(n_rays + rays_before[bool_sep])
+            n_rays += len(table)
+            tables.append(table)
+    if link_column is None:
+        # Rays before the first separator only make a link if there are any, and trailing blank lines don't
+        if len(starts) == 0 or starts[0] > 0:
+            starts.insert(0, 0)
+        while separator == "" and len(starts) > 1 and starts[-1] == n_rays:
+            starts.pop()
+    offsets = starts + [n_rays]
+    ray_info = np.concatenate(tables) if len(tables) > 0 else np.zeros((0, 7))
+    return ray_info, np.array(offsets, dtype=np.int64)
+
 # Rays classes
 class Geometric():
     def __init__(
         self, ray_info_or_phase, tau=None, power=None, doa_az=None,
-        doa_el=None, dod_az=None, dod_el=None, bool_flip_RXTX=False):
+        doa_el=None, dod_az=None, dod_el=None, bool_flip_RXTX=False, bool_wrap=True):
         if tau is None:
-            ray_info = np.array(ray_info_or_phase)
+            if bool_wrap:
+                ray_info = np.array(ray_info_or_phase)
+            else:
+                # Already wrapped angles, keep the array (or memory map) without copying
+                ray_info = np.asarray(ray_info_or_phase)
             if len(ray_info.shape) == 1:
                 ray_info = ray_info[np.newaxis, :]
         else:
@@ -25,63 +161,20 @@ class Geometric():
                 ray_info = ray_info[np.newaxis, :]
             else:
                 ray_info = ray_info.T
-        ray_info[..., 3:7] = np.mod(ray_info[..., 3:7]+180, 360)-180
+        if bool_wrap:
+            ray_info[..., 3:7] = np.mod(ray_info[..., 3:7]+180, 360)-180
         self.ray_info = ray_info
         if bool_flip_RXTX:
             self.flip_RXTX()
     def flip_RXTX(self):
         if self.ray_info.size > 1:
-            ray_info = np.copy(self.ray_info)
-            self.ray_info[:, 3] = ray_info[:, 5]
-            self.ray_info[:, 4] = ray_info[:, 6]
-            self.ray_info[:, 5] = ray_info[:, 3]
-            self.ray_info[:, 6] = ray_info[:, 4]
+            # A new table, the rays of load_links may be a read-only memory map
+            self.ray_info = self.ray_info[:, [0, 1, 2, 5, 6, 3, 4]]
     def classify_rays(self):
-        epsilon = 1e-3
-        c = 3e8
-        bool_LoS = False
-        classification = []
-        for ii, (_, Tau, _, DoA_az, DoA_el, DoD_az, DoD_el) in enumerate(self):
-            DoA_az, DoA_el, DoD_az, DoD_el = [
-                np.deg2rad(a) for a in [DoA_az, DoA_el, DoD_az, DoD_el]]
-            if ii == 0:
-                Tau_0, DoA_az_0, DoA_el_0, DoD_az_0, DoD_el_0 =\
-                    Tau, DoA_az, DoA_el, DoD_az, DoD_el
-                DoA_0 = polar2cartesian(DoA_az, DoA_el)
-                DoD_0 = polar2cartesian(DoD_az, DoD_el)
-                if (np.abs(DoA_el+DoD_el) < epsilon) and\
-                    (np.abs(wrapangle(DoA_az-DoD_az-np.pi)) < epsilon):
-                    classification.append("LoS")
-                    bool_LoS = True
-                else:
-                    classification.append("pseudo-LoS")
-            else:
-                DoA = polar2cartesian(DoA_az, DoA_el)
-                DoD = polar2cartesian(DoD_az, DoD_el)
-                cosa = np.dot(DoA, DoA_0)
-                cosd = np.dot(DoD, DoD_0)
-                sina = np.sqrt(1-cosa**2)
-                sind = np.sqrt(1-cosd**2)
-                sinad = cosa*sind + sina*cosd
-                Tau_est = Tau_0*(sina+sind)/sinad
-                if np.abs(Tau_est-Tau)*c < epsilon:
-                    if bool_LoS:
-                        kind = "1order"
-                    else:
-                        kind = "pseudo-1order"
-                else:
-                    kind = "NLoS"
-                if np.abs(DoA_el+DoD_el) < epsilon:
-                    kind += " (Wall)"
-                if (np.abs(DoA_el-DoD_el) < epsilon) and\
-                    (np.abs(wrapangle(DoA_az-DoA_az_0)) < epsilon) and\
-                    (np.abs(wrapangle(DoD_az-DoD_az_0)) < epsilon):
-                    if DoA_el < 0:
-                        kind += " (Floor)"
-                    else:
-                        kind += " (Ceiling)"
-                classification.append(kind)
-        return classification
+        return labels(*self.classify())
+    def classify(self):
+        """Ray class codes and Wall/Floor/Ceiling flag bitmasks, see em.classify"""
+        return classify(self.ray_info)
     def first(self, n):
         return Geometric(self.ray_info[:n])
     def __iter__(self):
@@ -1,4 +1,5 @@
 import numpy as np
+import pywarraychannels.backends
 
 def __RCF__(rolloff_rc, t, M_rc):
     t_scaled = (rolloff_rc / M_rc) * t
@@ -9,20 +10,103 @@ def __RCF__(rolloff_rc, t, M_rc):
         inder_val = np.sinc(1/(2*rolloff_rc))*(np.pi/4)
     sinc_val = np.sinc(t / M_rc)
     cos_val = np.cos(np.pi * t_scaled)
-    denominator_no0 = denominator
-    denominator_no0[np.abs(denominator) < 1e-6] = 1
-    return np.where(np.abs(denominator) < 1e-6, inder_val, sinc_val * cos_val / denominator_no0)
+    singular = np.abs(denominator) < 1e-6
+    denominator_no0 = np.where(singular, 1, denominator)
+    return np.where(singular, np.asarray(inder_val, dtype=np.result_type(t, np.float32)), sinc_val * cos_val / denominator_no0)
+
+# Lookup tables of the RC pulse shared by all filters, (rolloff_rc, M_rc, step, support, dtype) -> samples at (-1, 0, 1, 2, ...)*step
+# set to 0 beyond the support
+__LUT__ = {}
+
+def __RCF_LUT__(rolloff_rc, M_rc, step, support, n, dtype=float):
+    key = (rolloff_rc, M_rc, step, support, np.dtype(dtype).str)
+    table = __LUT__.get(key)
+    if table is None or len(table) < n:
+        n = max(n, 2*len(table) if table is not None else 0)
+        t = (np.arange(n) - 1)*step
+        table = np.where(np.abs(t) > support, 0, __RCF__(rolloff_rc, t, M_rc)).astype(dtype)
+        __LUT__[key] = table
+    return table
 
 ### Filter classes
 class RCFilter():
-    def __init__(self, rolloff_rc = 0, M_rc = 1, early_samples = 0, late_samples = 0):
+    def __init__(self, rolloff_rc = 0, M_rc = 1, early_samples = 0, late_samples = 0, tolerance = None, interpolation = "cubic"):
+        """With tolerance=None the pulse is evaluated exactly, otherwise it's interpolated from an
+        oversampled lookup table and truncated where it falls below tolerance (absolute error bound)."""
         self.rolloff_rc = rolloff_rc
         self.M_rc = M_rc
         self.early_samples = early_samples
         self.late_samples = late_samples
+        if interpolation not in ["linear", "cubic"]:
+            raise ValueError("Interpolation {} not recognized, use \"linear\" or \"cubic\"".format(interpolation))
+        self.tolerance = tolerance
+        self.interpolation = interpolation
+    def support(self):
+        """Half-width (in samples) beyond which the pulse magnitude is below half the tolerance"""
+        if self.tolerance is None:
+            return np.inf
+        tolerance = self.tolerance/2
+        if self.rolloff_rc == 0:
+            return self.M_rc/(np.pi*tolerance)
+        # For |t| > M/rolloff the pulse is bounded by M^3/(3*pi*rolloff^2*|t|^3)
+        return max(self.M_rc/self.rolloff_rc, np.cbrt(self.M_rc**3/(3*np.pi*self.rolloff_rc**2*tolerance)))
+    def step(self):
+        """Table spacing for which the interpolation error is below half the tolerance"""
+        # Bernstein's inequality bounds the n-th derivative of the pulse by bandwidth**n
+        bandwidth = 2*np.pi*self.bandwidth()
+        tolerance = self.tolerance/2
+        if self.interpolation == "linear":
+            return np.sqrt(8*tolerance)/bandwidth
+        return np.power(128*tolerance/3, 1/4)/bandwidth
     def response(self, T, delay):
-        tt = np.arange(T + self.early_samples + self.late_samples)
+        """Pulse at the taps for the given delays, in the precision of delay (float32 stays float32)"""
+        first, window = self.response_window(T, delay)
+        D = T + self.early_samples + self.late_samples
+        if len(window) == D:
+            return window
+        response = np.zeros((D,) + window.shape[1:], dtype=window.dtype)
+        response[first:first+len(window)] = window
+        return response
+    def response_window(self, T, delay):
+        """First tap and response on the taps [first, last) reached by the pulse support of some delay, all taps
+        if the pulse isn't truncated (tolerance=None)"""
+        tt = np.arange(T + self.early_samples + self.late_samples, dtype=np.result_type(np.asarray(delay).dtype, np.float32))
         if not np.isscalar(delay) and not len(np.array(delay).shape) == 0:
             delay = np.array(delay)[np.newaxis, ...]
             tt = np.expand_dims(tt, tuple(np.arange(1, len(delay.shape))))
-        return __RCF__(self.rolloff_rc, (tt - self.early_samples - delay), self.M_rc)
+        if self.tolerance is None:
+            return 0, __RCF__(self.rolloff_rc, (tt - self.early_samples - delay), self.M_rc)
+        # Only evaluate the taps reached by the pulse support of some delay
+        if np.size(delay) == 0:
+            return 0, np.zeros(np.broadcast(tt, delay).shape, dtype=tt.dtype)
+        support = self.support()
+        first = max(int(np.floor(np.min(delay) + self.early_samples - support)), 0)
+        last = max(min(int(np.ceil(np.max(delay) + self.early_samples + support)) + 1, len(tt)), first)
+        return first, self.lookup(tt[first:last] - self.early_samples - delay)
+    def bandwidth(self):
+        """Highest frequency of the pulse [cycles/sample]"""
+        return (1 + self.rolloff_rc)/(2*self.M_rc)
+    def spectrum(self, f):
+        """Fourier transform of the pulse at the frequencies f [cycles/sample]"""
+        f = np.abs(np.asarray(f, dtype=float))*self.M_rc
+        f_pass, f_stop = (1 - self.rolloff_rc)/2, (1 + self.rolloff_rc)/2
+        if self.rolloff_rc == 0:
+            return self.M_rc*(f < f_pass) + self.M_rc/2*(f == f_pass)
+        transition = self.M_rc/2*(1 + np.cos(np.pi/self.rolloff_rc*(f - f_pass)))
+        return np.where(f <= f_pass, self.M_rc, np.where(f <= f_stop, transition, 0))
+    def lookup(self, t):
+        """Interpolate the pulse at t from the shared lookup table"""
+        step = self.step()
+        support = self.support()
+        # Constants in the precision of t so numexpr doesn't upcast
+        t = np.asarray(t)
+        step_t, u_max = t.dtype.type(step), t.dtype.type(np.ceil(support/step) + 1)
+        u = pywarraychannels.backends.evaluate("where(abs(t)/step_t < u_max, abs(t)/step_t, u_max)", {"t": t, "step_t": step_t, "u_max": u_max})
+        index = u.astype(np.intp)
+        table = __RCF_LUT__(self.rolloff_rc, self.M_rc, step, support, int(np.max(index, initial=0)) + 4, t.dtype)
+        u = pywarraychannels.backends.evaluate("u-floor(u)", {"u": u})
+        y0, y1 = table[1:].take(index), table[2:].take(index)
+        if self.interpolation == "linear":
+            return pywarraychannels.backends.evaluate("y0+u*(y1-y0)", {"u": u, "y0": y0, "y1": y1})
+        ym, y2 = table.take(index), table[3:].take(index)
+        return pywarraychannels.backends.evaluate("(3*(u+1)*(u-1)*(u-2)*y0 - u*(u-1)*(u-2)*ym - 3*(u+1)*u*(u-2)*y1 + (u+1)*u*(u-1)*y2)/6", {"u": u, "ym": ym, "y0": y0, "y1": y1, "y2": y2})
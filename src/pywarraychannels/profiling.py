@@ -0,0 +1,83 @@
+import numpy as np
+import time
+
+### Auxiliar
+# Active profiler, stages only pay for checking this while profiling is off
+__active__ = None
+
+def __arrays__(result):
+    if isinstance(result, np.ndarray):
+        return [result]
+    if isinstance(result, (tuple, list)):
+        return [r for r in result if isinstance(r, np.ndarray)]
+    return []
+
+def call(name, function, *args, **kwargs):
+    """function(*args, **kwargs), recorded as the step name of the current stage when profiling"""
+    profiler = __active__
+    if profiler is None:
+        return function(*args, **kwargs)
+    profiler.stack.append(name)
+    path = "/".join(profiler.stack)
+    start = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        profiler.stack.pop()
+    profiler.record(path, elapsed, __arrays__(result))
+    return result
+
+def stage(name=None):
+    """Decorator recording every call of a method as a stage (by default named Class.method)"""
+    def decorator(function):
+        stage_name = function.__qualname__ if name is None else name
+        def wrapper(*args, **kwargs):
+            if __active__ is None:
+                return function(*args, **kwargs)
+            return call(stage_name, function, *args, **kwargs)
+        wrapper.__name__, wrapper.__qualname__, wrapper.__doc__ = function.__name__, function.__qualname__, function.__doc__
+        return wrapper
+    return decorator
+
+### Profiler class
+class Profiler():
+    def __init__(self, callback=None):
+        """Records time, calls, output shapes and bytes of the stages run inside a with block.
+        Stages are nested, e.g. "AWGN.measure/Geometric.measure/codebooks". callback, if given, is called as
+        callback(path, elapsed, shapes, nbytes) after every step."""
+        self.callback = callback
+        self.records = {}
+        self.stack = []
+        self.previous = None
+    def __enter__(self):
+        global __active__
+        self.previous, __active__ = __active__, self
+        return self
+    def __exit__(self, *exc):
+        global __active__
+        __active__, self.previous = self.previous, None
+        return False
+    def record(self, path, elapsed, arrays):
+        shapes = [a.shape for a in arrays]
+        nbytes = int(sum(a.nbytes for a in arrays))
+        record = self.records.setdefault(path, {"calls": 0, "time": 0., "bytes": 0, "shapes": shapes})
+        record["calls"] += 1
+        record["time"] += elapsed
+        record["bytes"] += nbytes
+        record["shapes"] = shapes
+        if self.callback is not None:
+            self.callback(path, elapsed, shapes, nbytes)
+    def report(self):
+        """Records as {path: {"calls", "time" [s], "bytes" (of the outputs), "shapes" (of the last output)}}"""
+        return {path: dict(record) for path, record in self.records.items()}
+    def reset(self):
+        self.records = {}
+    def __str__(self):
+        lines = ["{:<60s} {:>6s} {:>10s} {:>10s}  {}".format("Stage", "Calls", "Time [ms]", "MiB", "Shapes")]
+        for path in sorted(self.records):
+            record = self.records[path]
+            lines.append("{:<60s} {:>6d} {:>10.2f} {:>10.2f}  {}".format(
+                "  "*path.count("/") + path.split("/")[-1], record["calls"], 1e3*record["time"], record["bytes"]/2**20,
+                " ".join("x".join(str(n) for n in shape) for shape in record["shapes"])))
+        return "\n".join(lines)
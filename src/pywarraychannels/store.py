@@ -0,0 +1,177 @@
+import numpy as np
+import glob
+import hashlib
+import json
+import os
+import socket
+import uuid
+
+# Auxiliar
+def __write_json__(filename, content):
+    # Write then rename, readers never see a partially written file
+    temporary = "{}.{}.tmp".format(filename, uuid.uuid4().hex)
+    with open(temporary, "w") as f:
+        json.dump(content, f, indent=1)
+    os.replace(temporary, filename)
+
+def antenna_metadata(antenna):
+    """Geometry and codebook fingerprint of an antenna"""
+    operator = antenna.codebook_operator()
+    factors = [operator.codebook1, operator.codebook2] if hasattr(operator, "codebook1") else [operator.dense()]
+    codebook_hash = hashlib.sha1()
+    for factor in factors:
+        codebook_hash.update(np.ascontiguousarray(factor).tobytes())
+    return {
+        "class": type(antenna).__name__,
+        "antenna_elements": np.asarray(antenna.antenna_elements).tolist(),
+        "z_positive": bool(antenna.z_positive),
+        "uncertainty": type(antenna.uncertainty).__name__,
+        "codebook_shape": list(operator.shape),
+        "codebook_sha1": codebook_hash.hexdigest()}
+
+def channel_metadata(channel, seed=None):
+    """Parameters of a channel wrapper chain (AWGN, Rician, MIMO, ... down to Geometric) and the RNG seed"""
+    chain = []
+    while True:
+        chain.append({"class": type(channel).__name__})
+        for attribute in ["k", "amp", "sigma"]:
+            if hasattr(channel, attribute):
+                chain[-1][attribute] = float(getattr(channel, attribute))
+        if not hasattr(channel, "channel_dependency"):
+            break
+        channel = channel.channel_dependency
+    filter = {key: value for key, value in vars(channel.filter).items() if isinstance(value, (bool, int, float, str, type(None)))}
+    filter["class"] = type(channel.filter).__name__
+    return {
+        "chain": chain,
+        "f_c": float(channel.f_c),
+        "B": float(channel.B),
+        "K": len(channel.f_k),
+        "bool_sync": bool(channel.bool_sync),
+        "dtype": np.dtype(getattr(channel, "dtype", complex)).str,
+        "filter": filter,
+        "antenna_RX": antenna_metadata(channel.antenna_RX),
+        "antenna_TX": antenna_metadata(channel.antenna_TX),
+        "seed": None if seed is None else np.asarray(seed).tolist()}
+
+### Store classes
+class Writer():
+    def __init__(self, path, shape, dtype="complex", metadata=None, chunk_items=1024, name=None):
+        """Appender to the store in the directory path, items of the given shape and dtype are written to
+        memory-mapped shards of chunk_items items. Several writers (e.g. one per process or host) can append
+        to the same store as long as their names differ, each one writes only its own shards and index.
+        Appended items are visible to readers after flush (or close), close also trims the last shard to its items."""
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_items = chunk_items
+        self.name = "{}-{}-{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]) if name is None else name
+        os.makedirs(path, exist_ok=True)
+        header = {"shape": list(self.shape), "dtype": self.dtype.str, "metadata": metadata}
+        try:
+            with open(os.path.join(path, "metadata.json"), "x") as f:
+                json.dump(header, f, indent=1)
+        except FileExistsError:
+            header = Reader.header(path)
+            if tuple(header["shape"]) != self.shape or np.dtype(header["dtype"]) != self.dtype:
+                raise ValueError("Store {} holds items {} {}, not {} {}".format(path, header["shape"], header["dtype"], self.shape, self.dtype))
+        self.index_file = os.path.join(path, "appender-{}.json".format(self.name))
+        self.shards = []
+        self.data, self.indices, self.count = None, None, 0
+    def append(self, item, index=-1):
+        """Append one item, index is an optional key (e.g. the sample number) stored alongside"""
+        if self.data is None or self.count == self.chunk_items:
+            self.__new_shard__()
+        self.data[self.count] = item
+        self.indices[self.count] = index
+        self.count += 1
+        self.shards[-1]["count"] = self.count
+    def extend(self, items, indices=None):
+        for n, item in enumerate(items):
+            self.append(item, -1 if indices is None else indices[n])
+    def __new_shard__(self):
+        if self.data is not None:
+            self.flush()
+        shard = "{}-{:06d}".format(self.name, len(self.shards))
+        self.data = np.lib.format.open_memmap(os.path.join(self.path, shard + ".npy"), mode="w+", dtype=self.dtype, shape=(self.chunk_items,) + self.shape)
+        self.indices = np.lib.format.open_memmap(os.path.join(self.path, shard + ".index.npy"), mode="w+", dtype=np.int64, shape=(self.chunk_items,))
+        self.count = 0
+        self.shards.append({"file": shard, "count": 0})
+    def flush(self):
+        if self.data is not None:
+            self.data.flush()
+            self.indices.flush()
+        __write_json__(self.index_file, {"shards": self.shards})
+    def close(self):
+        self.flush()
+        if self.data is not None and self.count < self.chunk_items:
+            self.__trim__()
+        self.data, self.indices = None, None
+    def __trim__(self):
+        # Rewrite the last shard with only its items, dropping the unused part of the preallocated chunk
+        shard = os.path.join(self.path, self.shards[-1]["file"])
+        for filename, mapped in [(shard + ".npy", self.data), (shard + ".index.npy", self.indices)]:
+            temporary = "{}.{}.tmp".format(filename, uuid.uuid4().hex)
+            with open(temporary, "wb") as f:
+                np.save(f, mapped[:self.count])
+            os.replace(temporary, filename)
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+class Reader():
+    def __init__(self, path):
+        """Random access to the items of a store, shards are memory-mapped and only the requested items are read.
+        Items are ordered by appender name and then by append order, indices() gives the key of each item."""
+        self.path = path
+        header = self.header(path)
+        self.shape = tuple(header["shape"])
+        self.dtype = np.dtype(header["dtype"])
+        self.metadata = header["metadata"]
+        self.refresh()
+    @staticmethod
+    def header(path):
+        with open(os.path.join(path, "metadata.json")) as f:
+            return json.load(f)
+    def refresh(self):
+        """Pick up the items flushed by the writers since the reader was opened"""
+        self.shards = []
+        for index_file in sorted(glob.glob(os.path.join(self.path, "appender-*.json"))):
+            with open(index_file) as f:
+                self.shards += [shard for shard in json.load(f)["shards"] if shard["count"] > 0]
+        self.offsets = np.cumsum([0] + [shard["count"] for shard in self.shards])
+        self.maps = {}
+    def __len__(self):
+        return int(self.offsets[-1])
+    def __shard__(self, n, suffix=".npy"):
+        key = (n, suffix)
+        if key not in self.maps:
+            self.maps[key] = np.load(os.path.join(self.path, self.shards[n]["file"] + suffix), mmap_mode="r")
+        return self.maps[key]
+    def __getitem__(self, key):
+        return self.__gather__(key, ".npy", self.shape, self.dtype)
+    def indices(self, key=slice(None)):
+        """Keys given at append of the selected items"""
+        return self.__gather__(key, ".index.npy", (), np.int64)
+    def __gather__(self, key, suffix, shape, dtype):
+        if isinstance(key, slice):
+            positions = np.arange(*key.indices(len(self)))
+        elif np.ndim(key) == 0:
+            positions = np.array(range(len(self))[key])
+        else:
+            positions = np.arange(len(self))[key]
+        bool_single = np.ndim(positions) == 0
+        positions = np.atleast_1d(positions)
+        shard = np.searchsorted(self.offsets, positions, side="right") - 1
+        result = np.empty((len(positions),) + shape, dtype=dtype)
+        for n in np.unique(shard):
+            selected = shard == n
+            local = positions[selected] - self.offsets[n]
+            mapped = self.__shard__(n, suffix)
+            if np.all(np.diff(local) == 1):
+                result[selected] = mapped[local[0]:local[-1]+1]
+            else:
+                result[selected] = mapped[local]
+        return result[0] if bool_single else result
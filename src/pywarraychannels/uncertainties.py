@@ -1,6 +1,34 @@
 import numpy as np
 
 
+# Auxiliar
+def rotation_z(a):
+    """Stack of rotation matrices (..., 3, 3) around the z axis"""
+    a_cos, a_sin, zero, one = np.cos(a), np.sin(a), np.zeros(np.shape(a)), np.ones(np.shape(a))
+    return np.stack([
+        np.stack([a_cos, -a_sin, zero], axis=-1),
+        np.stack([a_sin, a_cos, zero], axis=-1),
+        np.stack([zero, zero, one], axis=-1)], axis=-2)
+
+
+def rotation_y(a):
+    """Stack of rotation matrices (..., 3, 3) around the y axis"""
+    a_cos, a_sin, zero, one = np.cos(a), np.sin(a), np.zeros(np.shape(a)), np.ones(np.shape(a))
+    return np.stack([
+        np.stack([a_cos, zero, -a_sin], axis=-1),
+        np.stack([zero, one, zero], axis=-1),
+        np.stack([a_sin, zero, a_cos], axis=-1)], axis=-2)
+
+
+def rotation_x(a):
+    """Stack of rotation matrices (..., 3, 3) around the x axis"""
+    a_cos, a_sin, zero, one = np.cos(a), np.sin(a), np.zeros(np.shape(a)), np.ones(np.shape(a))
+    return np.stack([
+        np.stack([one, zero, zero], axis=-1),
+        np.stack([zero, a_cos, -a_sin], axis=-1),
+        np.stack([zero, a_sin, a_cos], axis=-1)], axis=-2)
+
+
 class Static():
     def __init__(self, pan=0, tilt=0, roll=0):
         self.state = [pan, tilt, roll]
@@ -16,34 +44,69 @@ class Static():
         roll_sin = np.sin(roll)
         self.transform = np.dot(self.transform, np.array(
             [[1, 0, 0], [0, roll_cos, -roll_sin], [0, roll_sin, roll_cos]]))
+        self.transform_single = self.transform
+        self.version = 0
 
-    def update(self):
-        pass
+    def sample(self, n):
+        """Stack of n transforms, all equal to the static one"""
+        return np.broadcast_to(self.transform_single, (n, 3, 3))
+
+    def update(self, n=None):
+        """With n, the transform becomes a stack of n orientations (a leading batch axis of the steering vectors)"""
+        self.version += 1
+        if n is None:
+            self.transform = self.transform_single
+        else:
+            self.transform = self.sample(n)
 
     def apply(self, dir):
-        return np.dot(dir, self.transform.T)
+        return np.matmul(dir, np.swapaxes(self.transform, -1, -2))
 
     def apply_inverse(self, dir):
-        return np.dot(dir, self.transform)
+        return np.matmul(dir, self.transform)
 
     def __str__(self):
-        return "Static: {:.1f} [deg]\nPan: {:.1f} [deg]\nRoll: {:.1f} [deg]".format(*self.state*180/np.pi)
+        return "Static: {:.1f} [deg]\nPan: {:.1f} [deg]\nRoll: {:.1f} [deg]".format(*np.array(self.state)*180/np.pi)
 
 
 class UniformTiltPanRoll():
-    def __init__(self, u_tilt=True, u_pan=True, u_roll=True):
+    def __init__(self, u_tilt=True, u_pan=True, u_roll=True, rng=None):
         self.u_tilt = u_tilt
         self.u_pan = u_pan
         self.u_roll = u_roll
+        self.rng = np.random if rng is None else np.random.default_rng(rng)
         self.state = np.zeros(3)
+        self.version = 0
         self.update()
 
-    def update(self):
+    def sample(self, n, bool_return_state=False):
+        """Stack of n random transforms (n, 3, 3), drawn at once"""
+        state = np.zeros((n, 3))
+        if self.u_tilt:
+            state[:, 0] = self.rng.uniform(-np.pi, np.pi, n)
+        if self.u_pan:
+            state[:, 1] = self.rng.uniform(-np.pi/2, np.pi/2, n)
+        if self.u_roll:
+            state[:, 2] = self.rng.uniform(-np.pi, np.pi, n)
+        transform = np.matmul(np.matmul(rotation_z(state[:, 0]), rotation_y(state[:, 1])), rotation_x(state[:, 2]))
+        if bool_return_state:
+            return transform, state
+        return transform
+
+    def update(self, n=None):
+        """With n, the transform becomes a stack of n orientations (a leading batch axis of the steering vectors)"""
+        # Every new orientation bumps the version so antennas drop their cached steering grids
+        self.version += 1
         if not (self.u_tilt or self.u_pan or self.u_roll):
+            self.transform, self.state = (np.eye(3), np.zeros(3)) if n is None else (np.broadcast_to(np.eye(3), (n, 3, 3)), np.zeros((n, 3)))
             return
+        if n is not None:
+            self.transform, self.state = self.sample(n, bool_return_state=True)
+            return
+        self.state = np.zeros(3)
         self.transform = np.eye(3)
         if self.u_tilt:
-            tilt = np.random.uniform(-np.pi, np.pi)
+            tilt = self.rng.uniform(-np.pi, np.pi)
             self.state[0] = tilt
             tilt_cos = np.cos(tilt)
             tilt_sin = np.sin(tilt)
@@ -52,14 +115,14 @@ class UniformTiltPanRoll():
         else:
             self.transform = np.eye(3)
         if self.u_pan:
-            pan = np.random.uniform(-np.pi/2, np.pi/2)
+            pan = self.rng.uniform(-np.pi/2, np.pi/2)
             self.state[1] = pan
             pan_cos = np.cos(pan)
             pan_sin = np.sin(pan)
             self.transform = np.dot(self.transform, np.array(
                 [[pan_cos, 0, -pan_sin], [0, 1, 0], [pan_sin, 0, pan_cos]]))
         if self.u_roll:
-            roll = np.random.uniform(-np.pi, np.pi)
+            roll = self.rng.uniform(-np.pi, np.pi)
             self.state[2] = roll
             roll_cos = np.cos(roll)
             roll_sin = np.sin(roll)
@@ -67,16 +130,16 @@ class UniformTiltPanRoll():
                 [[1, 0, 0], [0, roll_cos, -roll_sin], [0, roll_sin, roll_cos]]))
 
     def apply(self, dir):
-        if not (self.u_tilt or self.u_pan or self.u_roll):
+        if not (self.u_tilt or self.u_pan or self.u_roll) and np.ndim(self.transform) == 2:
             return dir
         else:
-            return np.dot(dir, self.transform.T)
+            return np.matmul(dir, np.swapaxes(self.transform, -1, -2))
 
     def apply_inverse(self, dir):
-        if not (self.u_tilt or self.u_pan or self.u_roll):
+        if not (self.u_tilt or self.u_pan or self.u_roll) and np.ndim(self.transform) == 2:
             return dir
         else:
-            return np.dot(dir, self.transform)
+            return np.matmul(dir, self.transform)
 
     def __str__(self):
         return "Tilt: {:.1f} [deg]\nPan: {:.1f} [deg]\nRoll: {:.1f} [deg]".format(*self.state*180/np.pi)
@@ -1,19 +1,19 @@
 import numpy as np
 
 def water_filling(depth, volume, return_cells=False):
-    depth_sorted = np.sort(depth)
-    depth_sorted_min = depth_sorted[0]
-    depth_sorted -= depth_sorted_min
-    depth_sorted_cumsum = np.cumsum(depth_sorted)
-    levels = (depth_sorted_cumsum + volume)/np.arange(1, len(depth_sorted) + 1)
-    level_win = 0
-    for level, depth_s in zip(levels, depth_sorted):
-        if level > depth_s:
-            level_win = level
-        else:
-            break
-    level = level_win + depth_sorted_min
+    """Water level over the cells of depth (..., N) filled with volume (broadcastable to ...), or the water
+    in every cell (..., N) if return_cells. Every leading index is an independent problem."""
+    depth = np.asarray(depth)
+    depth_sorted = np.sort(depth, axis=-1)
+    depth_sorted_min = depth_sorted[..., :1]
+    depth_sorted = depth_sorted - depth_sorted_min
+    levels = (np.cumsum(depth_sorted, axis=-1) + np.asarray(volume)[..., np.newaxis])/np.arange(1, depth.shape[-1] + 1)
+    # The level of the first k cells holds while it covers the (k-1)-th deepest, keep the last one before it fails
+    covered = levels > depth_sorted
+    n_covered = np.where(np.all(covered, axis=-1), depth.shape[-1], np.argmin(covered, axis=-1))
+    level_win = np.take_along_axis(levels, np.maximum(n_covered - 1, 0)[..., np.newaxis], axis=-1)
+    level = np.where(n_covered[..., np.newaxis] > 0, level_win, 0) + depth_sorted_min
     if return_cells:
         return np.maximum(level - depth, 0)
     else:
-        return level
\ No newline at end of file
+        return level[..., 0][()]